@@ -0,0 +1,91 @@
+"""按 token 的自适应并发上限（AIMD + 延迟梯度）。
+
+zai.is 各账号的实际容量随时段变化，静态的并发设置跟不上。每个 token 维护一个并发上限：
+
+- 成功且在途请求数接近上限时加性增长（每个完整窗口 +1）；
+- 429、超时和 502/503/504 时乘性下降（ADAPTIVE_LIMIT_BACKOFF）；
+- 流式首字节耗时的短期 EWMA 超过长期基线的 ADAPTIVE_LATENCY_TOLERANCE 倍时小幅下降；
+- 两次下降之间至少间隔一个近期延迟（且不少于 1 秒），一阵集中的失败只算一次。
+
+上限始终计算并展示在 /api/tokens；ADAPTIVE_LIMIT_ENABLED 开启时选号才按它限制在途请求数，
+低优先级请求的预留（PRIORITY_RESERVED_SHARE）则始终按它计算。
+状态只保存在内存中。
+"""
+import math
+import time
+from threading import Lock
+
+import settings
+from token_pool import TokenRecord
+
+OVERLOAD_STATUS = (429, 502, 503, 504)
+
+_SHORT_ALPHA = 0.3
+_LONG_ALPHA = 0.02
+_LATENCY_BACKOFF = 0.9
+
+_lock = Lock()
+
+
+def _clamp(value: float) -> float:
+    return min(float(settings.ADAPTIVE_LIMIT_MAX), max(float(settings.ADAPTIVE_LIMIT_MIN), value))
+
+
+def _limit(record: TokenRecord) -> float:
+    if record.al_limit is None:
+        record.al_limit = _clamp(settings.ADAPTIVE_LIMIT_INITIAL)
+    return record.al_limit
+
+
+def _decrease(record: TokenRecord, factor: float, now: float) -> bool:
+    interval = max(1.0, record.al_latency_short or 0.0)
+    if now - record.al_decreased_at < interval:
+        return False
+    record.al_limit = _clamp(_limit(record) * factor)
+    record.al_decreased_at = now
+    return True
+
+
+def on_success(record: TokenRecord, latency: float | None = None):
+    """收到首字节时调用；latency 为流式首字节耗时（非流式请求的耗时随输出长度变化，不参与梯度）。"""
+    now = time.monotonic()
+    with _lock:
+        limit = _limit(record)
+        if latency is not None:
+            if record.al_latency_short is None:
+                record.al_latency_short = record.al_latency_long = latency
+            else:
+                record.al_latency_short += _SHORT_ALPHA * (latency - record.al_latency_short)
+                record.al_latency_long += _LONG_ALPHA * (latency - record.al_latency_long)
+            if record.al_latency_short > record.al_latency_long * settings.ADAPTIVE_LATENCY_TOLERANCE:
+                _decrease(record, _LATENCY_BACKOFF, now)
+                return
+        # 只有真的用到了上限才说明还能再加
+        if record.in_flight >= limit / 2:
+            record.al_limit = _clamp(limit + 1.0 / limit)
+
+
+def on_overload(record: TokenRecord):
+    """429 / 超时 / 网关错误时调用。"""
+    with _lock:
+        _decrease(record, settings.ADAPTIVE_LIMIT_BACKOFF, time.monotonic())
+
+
+def current(record: TokenRecord) -> int:
+    """当前的在途请求数上限（取整），不论是否开启都会计算。"""
+    return max(1, math.floor(_limit(record)))
+
+
+def cap(record: TokenRecord) -> int | None:
+    """选号使用的在途请求数上限；未开启时返回 None。"""
+    if not settings.ADAPTIVE_LIMIT_ENABLED:
+        return None
+    return current(record)
+
+
+def snapshot(record: TokenRecord) -> dict:
+    return {
+        'concurrency_limit': round(_limit(record), 2),
+        'latency_ewma': round(record.al_latency_short, 3) if record.al_latency_short is not None else None,
+        'latency_baseline': round(record.al_latency_long, 3) if record.al_latency_long is not None else None,
+    }
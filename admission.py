@@ -0,0 +1,163 @@
+"""所有 token 都在忙或冷却时的准入排队，替代立即返回 503。
+
+- 请求在队列中等待 token 名额，最多 ADMISSION_QUEUE_TIMEOUT 秒，队列长度上限为
+  ADMISSION_QUEUE_MAX（0 表示不排队，与原来一样立即 503）；
+- 排序：高优先级请求总在低优先级之前；同一优先级内 fifo 先到先得，priority 按调用方
+  Key 的 weight 从高到低、同级先到先得。低优先级请求只能占到预留之外的余量；
+- 有 token 归还名额时唤醒队首，队首占不到时把机会依次传给后面的请求（不同请求的类型
+  和模型不同，队首占不到不代表后面的也占不到）；冷却和熔断到期没有事件，队首定期重试；
+- 入队前先估计最早什么时候可能有 token 可用：所有 token 都在冷却 / 熔断且在
+  ADMISSION_QUEUE_TIMEOUT 内不会结束（或没有可用 token）时直接拒绝，不再白等到超时；
+- 拒绝时给出 Retry-After：最近一个 token 冷却 / 熔断结束的时间，都只是在忙时为 1 秒。
+"""
+import bisect
+import itertools
+import math
+import threading
+import time
+from collections import deque
+from threading import Lock
+
+import circuit_breaker
+import settings
+import token_scheduler
+from token_pool import pool
+
+_POLL_INTERVAL = 0.25
+
+
+class _Entry:
+    __slots__ = ('rank', 'seq', 'event')
+
+    def __init__(self, rank: tuple, seq: int):
+        self.rank = rank
+        self.seq = seq
+        self.event = threading.Event()
+
+    def __lt__(self, other):
+        return (self.rank, self.seq) < (other.rank, other.seq)
+
+
+class AdmissionQueue:
+    def __init__(self):
+        self._lock = Lock()
+        self._entries: list[_Entry] = []   # 按 (rank, seq) 排序
+        self._seq = itertools.count()
+        self._waits = deque(maxlen=1000)   # 最近成功出队的等待秒数
+        self._stats = {'queued': 0, 'admitted': 0, 'timeouts': 0, 'rejected_full': 0, 'rejected_unavailable': 0, 'max_depth': 0}
+
+    def wait(self, try_acquire, rank: tuple = (0, 0.0)):
+        """排队直到 try_acquire() 返回非 None；返回 (结果, None) 或 (None, 拒绝原因)。"""
+        ready = ready_in()
+        if ready is None or ready > settings.ADMISSION_QUEUE_TIMEOUT:
+            # 超时前不会有 token 冷却 / 熔断结束，排队只会白等
+            with self._lock:
+                self._stats['rejected_unavailable'] += 1
+            return None, 'unavailable'
+        with self._lock:
+            if len(self._entries) >= settings.ADMISSION_QUEUE_MAX:
+                self._stats['rejected_full'] += 1
+                return None, 'full'
+            entry = _Entry(rank, next(self._seq))
+            bisect.insort(self._entries, entry)
+            self._stats['queued'] += 1
+            self._stats['max_depth'] = max(self._stats['max_depth'], len(self._entries))
+        started = time.monotonic()
+        deadline = started + settings.ADMISSION_QUEUE_TIMEOUT
+        result = None
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    with self._lock:
+                        self._stats['timeouts'] += 1
+                    return None, 'timeout'
+                signalled = entry.event.wait(min(remaining, _POLL_INTERVAL))
+                entry.event.clear()
+                if not signalled and not self._is_head(entry):
+                    continue
+                result = try_acquire()
+                if result is not None:
+                    waited = time.monotonic() - started
+                    with self._lock:
+                        self._stats['admitted'] += 1
+                        self._waits.append(waited)
+                    return result, None
+                self._pass(entry)
+        finally:
+            with self._lock:
+                i = bisect.bisect_left(self._entries, entry)
+                if i < len(self._entries) and self._entries[i] is entry:
+                    del self._entries[i]
+            if result is not None:
+                # 可能还有空闲名额，让下一个请求也试一次
+                self.notify()
+
+    def _is_head(self, entry: _Entry) -> bool:
+        with self._lock:
+            return bool(self._entries) and self._entries[0] is entry
+
+    def _pass(self, entry: _Entry):
+        with self._lock:
+            i = bisect.bisect_right(self._entries, entry)
+            if i < len(self._entries):
+                self._entries[i].event.set()
+
+    def notify(self):
+        """有 token 名额归还时调用：唤醒队首。"""
+        with self._lock:
+            if self._entries:
+                self._entries[0].event.set()
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._stats)
+            out['depth'] = len(self._entries)
+            out['depth_low'] = sum(1 for e in self._entries if e.rank[0] > 0)
+            waits = sorted(self._waits)
+        out['max_queue'] = settings.ADMISSION_QUEUE_MAX
+        out['timeout'] = settings.ADMISSION_QUEUE_TIMEOUT
+        out['order'] = settings.ADMISSION_QUEUE_ORDER
+        if waits:
+            out['wait_p50'] = round(waits[len(waits) // 2], 3)
+            out['wait_p95'] = round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3)
+            out['wait_max'] = round(waits[-1], 3)
+        else:
+            out['wait_p50'] = out['wait_p95'] = out['wait_max'] = None
+        return out
+
+
+def rank_of(client, priority: str) -> tuple:
+    level = token_scheduler.PRIORITIES.index(priority)
+    if settings.ADMISSION_QUEUE_ORDER == 'priority':
+        return level, -float(client.weight or 1)
+    return level, 0.0
+
+
+def ready_in() -> float | None:
+    """最早可能有 token 可用的秒数：有 token 只是在忙时为 0，没有可用 token 时为 None。"""
+    now = time.monotonic()
+    soonest = None
+    for record in pool.records():
+        if not record.usable:
+            continue
+        until = record.cooldown_until
+        if record.cb_state == circuit_breaker.OPEN:
+            until = max(until, record.cb_open_until)
+        if until <= now:
+            # 有 token 只是在忙
+            return 0.0
+        soonest = until if soonest is None else min(soonest, until)
+    return None if soonest is None else soonest - now
+
+
+def retry_after() -> int:
+    """建议客户端重试前等待的秒数。"""
+    ready = ready_in()
+    if ready is None:
+        return max(1, math.ceil(settings.ADMISSION_QUEUE_TIMEOUT))
+    return max(1, math.ceil(ready))
+
+
+queue = AdmissionQueue()
+token_scheduler.on_release(queue.notify)
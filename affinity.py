@@ -0,0 +1,122 @@
+"""多轮对话的 token 粘滞路由（AFFINITY_ENABLED 开启）。
+
+同一个对话的后续请求尽量发给上一次成功处理它的 token，保留上游按账号的前缀 / KV 缓存：
+
+- 对话标识优先取请求头 X-Session-Id 或请求体的 user 字段（按调用方 Key 区分，不同 Key
+  的相同取值互不影响），否则取对话前缀（开头的 system 消息加上最早的
+  AFFINITY_PREFIX_MESSAGES 条其他消息）的 SHA-256，并带上模型名；
+- 对话 -> token 的映射保存在内存中，LRU 淘汰（最多 AFFINITY_MAX_ENTRIES 条），
+  AFFINITY_TTL 秒未使用后过期；
+- 粘滞的 token 不可用、冷却 / 熔断中、配额快耗尽或占不到并发名额时按正常选号处理，
+  成功后映射更新为新的 token。
+"""
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import model_catalog
+import settings
+import token_scheduler
+from token_pool import pool
+
+SESSION_HEADER = 'X-Session-Id'
+_SYSTEM_ROLES = ('system', 'developer')
+
+_lock = Lock()
+_table: OrderedDict[str, tuple[int, float]] = OrderedDict()  # key -> (token id, 过期时间)
+_stats = {'hits': 0, 'misses': 0, 'fallbacks': 0, 'evictions': 0, 'expirations': 0}
+
+
+def key_for(payload: dict, headers, client) -> str | None:
+    """返回对话标识；未开启或无法识别对话时返回 None。client 为调用方的 ClientState。"""
+    if not settings.AFFINITY_ENABLED:
+        return None
+    session = headers.get(SESSION_HEADER) or payload.get('user')
+    if session:
+        raw = f"s:{client.id}:{session}"
+    else:
+        messages = payload.get('messages')
+        if not isinstance(messages, list):
+            return None
+        prefix = []
+        taken = 0
+        for message in messages:
+            if not isinstance(message, dict):
+                break
+            if message.get('role') in _SYSTEM_ROLES and not taken:
+                prefix.append(message)
+                continue
+            if taken >= settings.AFFINITY_PREFIX_MESSAGES:
+                break
+            prefix.append(message)
+            taken += 1
+        if not taken:
+            return None
+        try:
+            raw = 'p:' + json.dumps(prefix, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+        except (TypeError, ValueError):
+            return None
+    raw = f"{payload.get('model')}\n{raw}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _lookup(key: str) -> int | None:
+    now = time.monotonic()
+    with _lock:
+        entry = _table.get(key)
+        if entry is None:
+            _stats['misses'] += 1
+            return None
+        token_id, expires_at = entry
+        if expires_at <= now:
+            del _table[key]
+            _stats['expirations'] += 1
+            _stats['misses'] += 1
+            return None
+        _table.move_to_end(key)
+        return token_id
+
+
+def claim(key: str, kind: str, model: str | None, priority: str):
+    """占用该对话粘滞的 token；没有映射或 token 不适合时返回 None，调用方按正常选号处理。
+
+    每个请求只调用一次，命中率按请求计算。
+    """
+    token_id = _lookup(key)
+    if token_id is None:
+        return None
+    record = pool.get(token_id)
+    lease = None
+    if (record is not None and record.usable
+            and not (model_catalog.known(model) and not model_catalog.supports(record, model))
+            and token_scheduler.tier(record, kind) == 0):
+        lease = token_scheduler.acquire(record, kind, priority)
+    with _lock:
+        if lease is None:
+            _stats['fallbacks'] += 1
+            if record is None:
+                _table.pop(key, None)
+        else:
+            _stats['hits'] += 1
+    return lease
+
+
+def remember(key: str, token_id: int):
+    with _lock:
+        _table[key] = (token_id, time.monotonic() + settings.AFFINITY_TTL)
+        _table.move_to_end(key)
+        while len(_table) > settings.AFFINITY_MAX_ENTRIES:
+            _table.popitem(last=False)
+            _stats['evictions'] += 1
+
+
+def stats() -> dict:
+    with _lock:
+        out = dict(_stats)
+        out['entries'] = len(_table)
+    lookups = out['hits'] + out['misses'] + out['fallbacks']
+    out['hit_rate'] = round(out['hits'] / lookups, 3) if lookups else 0.0
+    out['enabled'] = settings.AFFINITY_ENABLED
+    return out
@@ -1,7 +1,10 @@
 import os
 import time
+import atexit
 import logging
 import json
+import math
+import secrets
 import hashlib
 import sqlite3
 from datetime import datetime
@@ -10,11 +13,32 @@ from flask import Flask, request, jsonify, render_template, send_from_directory,
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from apscheduler.schedulers.background import BackgroundScheduler
-import requests
 
 from extensions import db
-from models import SystemConfig, Token, RequestLog
+from models import SystemConfig, Token, RequestLog, ClientKey
+import adaptive_limit
+import admission
+import affinity
+import circuit_breaker
+import client_keys
+import coalescer
+import config_cache
+import hedging
+import log_writer
+import model_catalog
+import proxy_attempt
+import rate_limits
+import request_body
+import response_cache
 import services
+import settings
+import sse
+import stream_resume
+import token_health
+import token_latency
+import token_pool
+import token_scheduler
+import upstream
 
 # Initialize App
 app = Flask(__name__, static_folder='static', template_folder='static')
@@ -23,6 +47,7 @@ app = Flask(__name__, static_folder='static', template_folder='static')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URI', 'sqlite:///zai2api.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-change-me')
+app.config['MAX_CONTENT_LENGTH'] = settings.MAX_REQUEST_BODY_BYTES or None
 
 # Initialize DB
 db.init_app(app)
@@ -36,6 +61,10 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login_page'
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f"Request body exceeds {settings.MAX_REQUEST_BODY_BYTES} bytes"}), 413
+
 class User(UserMixin):
     def __init__(self, id, username):
         self.id = id
@@ -44,7 +73,7 @@ class User(UserMixin):
 @login_manager.user_loader
 def load_user(user_id):
     # We only have one admin user
-    config = SystemConfig.query.first()
+    config = config_cache.get()
     if config and str(config.id) == user_id:
         return User(id=str(config.id), username=config.admin_username)
     return None
@@ -99,13 +128,25 @@ def migrate_sqlite_schema():
             if 'stream_conversion_enabled' not in sc_cols:
                 cur.execute("ALTER TABLE system_config ADD COLUMN stream_conversion_enabled BOOLEAN DEFAULT 0")
 
-        # token: add zai_darkknight and darkknight_source columns
+        # token: add zai_darkknight, darkknight_source, health timestamp and weight columns
         token_cols = _sqlite_table_columns(cur, 'token')
         if token_cols:
             if 'zai_darkknight' not in token_cols:
                 cur.execute("ALTER TABLE token ADD COLUMN zai_darkknight TEXT")
             if 'darkknight_source' not in token_cols:
                 cur.execute("ALTER TABLE token ADD COLUMN darkknight_source TEXT DEFAULT 'auto'")
+            if 'last_success_at' not in token_cols:
+                cur.execute("ALTER TABLE token ADD COLUMN last_success_at DATETIME")
+            if 'last_error_at' not in token_cols:
+                cur.execute("ALTER TABLE token ADD COLUMN last_error_at DATETIME")
+            if 'weight' not in token_cols:
+                cur.execute("ALTER TABLE token ADD COLUMN weight INTEGER DEFAULT 1")
+
+        # client_key: add priority column
+        ck_cols = _sqlite_table_columns(cur, 'client_key')
+        if ck_cols:
+            if 'priority' not in ck_cols:
+                cur.execute("ALTER TABLE client_key ADD COLUMN priority TEXT")
 
         # request_log: add missing columns for UI display
         rl_cols = _sqlite_table_columns(cur, 'request_log')
@@ -146,6 +187,7 @@ def init_db():
                 # Make sure old sqlite DBs get new columns before ORM queries start
                 migrate_sqlite_schema()
                 db.create_all()
+                token_pool.pool.load(Token.query.order_by(Token.id.asc()).all())
                 config = SystemConfig.query.first()
                 if not config:
                     # Default Admin: admin / admin
@@ -157,6 +199,7 @@ def init_db():
                     db.session.add(config)
                     db.session.commit()
                     print("Initialized default admin/admin")
+                config_cache.invalidate()
 
                 # Ensure scheduler interval reflects persisted config (survives restart)
                 try:
@@ -176,9 +219,24 @@ def scheduled_refresh():
     with app.app_context():
         services.refresh_all_tokens()
 
+def scheduled_health_flush():
+    with app.app_context():
+        token_health.flush()
+
+def scheduled_models_refresh():
+    model_catalog.refresh()
+
+def scheduled_latency_probe():
+    token_latency.probe_idle()
+
 scheduler = BackgroundScheduler()
 scheduler.add_job(scheduled_refresh, 'interval', seconds=3600, id='token_refresher')
+scheduler.add_job(scheduled_health_flush, 'interval', seconds=settings.TOKEN_HEALTH_FLUSH_INTERVAL, id='token_health_flush')
+scheduler.add_job(scheduled_models_refresh, 'interval', seconds=settings.MODELS_REFRESH_INTERVAL, id='models_refresh')
+if settings.LATENCY_PROBE_INTERVAL > 0:
+    scheduler.add_job(scheduled_latency_probe, 'interval', seconds=settings.LATENCY_PROBE_INTERVAL, id='latency_probe')
 scheduler.start()
+atexit.register(scheduled_health_flush)
 
 # --- Routes: Pages ---
 
@@ -267,6 +325,7 @@ def api_auth_required(f):
 @app.route('/api/stats', methods=['GET'])
 @api_auth_required
 def api_stats():
+    token_health.flush()
     total_tokens = Token.query.count()
     active_tokens = Token.query.filter_by(is_active=True).count()
     # Mocking today stats for now or deriving from logs if detailed
@@ -288,10 +347,12 @@ def api_stats():
 @app.route('/api/tokens', methods=['GET'])
 @api_auth_required
 def get_tokens():
+    token_health.flush()
     tokens = Token.query.all()
-    config = SystemConfig.query.first()
+    config = config_cache.get()
     result = []
     for t in tokens:
+        record = token_pool.pool.get(t.id)
         result.append({
             'id': t.id,
             'email': t.email,
@@ -309,6 +370,13 @@ def get_tokens():
             'video_enabled': t.video_enabled,
             'image_concurrency': t.image_concurrency,
             'video_concurrency': t.video_concurrency,
+            'weight': t.weight,
+            'in_flight': record.in_flight if record else 0,
+            'circuit_state': record.cb_state if record else None,
+            'timeouts': dict(record.timeouts) if record else None,
+            'concurrency_limit': adaptive_limit.snapshot(record)['concurrency_limit'] if record else None,
+            'ttfb_ewma': token_latency.snapshot(record)['ttfb_ewma'] if record else None,
+            'model_count': len(record.models) if record and record.models is not None else None,
             'zai_token': t.zai_token,
             'zai_darkknight': t.zai_darkknight,
             'darkknight_source': t.darkknight_source,
@@ -348,6 +416,7 @@ def add_token():
         video_enabled=data.get('video_enabled', True),
         image_concurrency=data.get('image_concurrency', -1),
         video_concurrency=data.get('video_concurrency', -1),
+        weight=data.get('weight', 1),
         zai_darkknight=darkknight,
         darkknight_source=darkknight_source
     )
@@ -385,6 +454,7 @@ def update_token(id):
     if 'video_enabled' in data: token.video_enabled = data['video_enabled']
     if 'image_concurrency' in data: token.image_concurrency = data['image_concurrency']
     if 'video_concurrency' in data: token.video_concurrency = data['video_concurrency']
+    if 'weight' in data: token.weight = data['weight']
     
     db.session.commit()
     return jsonify({'success': True})
@@ -509,6 +579,7 @@ def admin_config():
         if 'stream_conversion_enabled' in data: config.stream_conversion_enabled = bool(data['stream_conversion_enabled'])
         
         db.session.commit()
+        config_cache.invalidate()
         return jsonify({'success': True})
 
 @app.route('/api/admin/apikey', methods=['POST'])
@@ -522,6 +593,7 @@ def update_apikey():
     config = SystemConfig.query.first()
     config.api_key = new_key
     db.session.commit()
+    config_cache.invalidate()
     return jsonify({'success': True})
 
 @app.route('/api/admin/password', methods=['POST'])
@@ -542,6 +614,7 @@ def update_password():
     if username:
         config.admin_username = username
     db.session.commit()
+    config_cache.invalidate()
     return jsonify({'success': True})
 
 @app.route('/api/admin/debug', methods=['POST'])
@@ -558,6 +631,7 @@ def admin_debug():
             logger.error(f"Failed to reschedule job: {e}")
             
     db.session.commit()
+    config_cache.invalidate()
     return jsonify({'success': True})
 
 @app.route('/api/proxy/config', methods=['GET', 'POST'])
@@ -574,8 +648,121 @@ def proxy_config():
         if 'proxy_enabled' in data: config.proxy_enabled = data['proxy_enabled']
         if 'proxy_url' in data: config.proxy_url = data['proxy_url']
         db.session.commit()
+        config_cache.invalidate()
         return jsonify({'success': True})
 
+# --- Client Key Routes ---
+
+_CLIENT_KEY_FIELDS = ('name', 'remark', 'is_active', 'rps', 'burst', 'max_streams', 'tpm', 'weight', 'priority')
+
+def _client_key_dict(row: ClientKey) -> dict:
+    state = client_keys.state_of(row.id)
+    return {
+        'id': row.id,
+        'name': row.name,
+        'key': row.key,
+        'is_active': row.is_active,
+        'remark': row.remark,
+        'rps': row.rps,
+        'burst': row.burst,
+        'max_streams': row.max_streams,
+        'tpm': row.tpm,
+        'weight': row.weight,
+        'priority': row.priority,
+        'created_at': _dt_iso(row.created_at),
+        'usage': client_keys.snapshot(state) if state else None,
+    }
+
+@app.route('/api/client-keys', methods=['GET'])
+@api_auth_required
+def list_client_keys():
+    client_keys.ensure_loaded()
+    return jsonify({'success': True, 'keys': [_client_key_dict(k) for k in ClientKey.query.order_by(ClientKey.id.asc()).all()]})
+
+@app.route('/api/client-keys', methods=['POST'])
+@api_auth_required
+def add_client_key():
+    data = request.json or {}
+    if not data.get('name'):
+        return jsonify({'success': False, 'message': 'Missing name'}), 400
+    key = data.get('key') or f"sk-{secrets.token_urlsafe(32)}"
+    if ClientKey.query.filter_by(key=key).first() is not None:
+        return jsonify({'success': False, 'message': 'Key already exists'}), 400
+    row = ClientKey(key=key)
+    for name in _CLIENT_KEY_FIELDS:
+        if name in data: setattr(row, name, data[name])
+    db.session.add(row)
+    db.session.commit()
+    client_keys.invalidate()
+    return jsonify({'success': True, 'id': row.id, 'key': row.key})
+
+@app.route('/api/client-keys/<int:id>', methods=['PUT'])
+@api_auth_required
+def update_client_key(id):
+    row = ClientKey.query.get_or_404(id)
+    data = request.json or {}
+    for name in _CLIENT_KEY_FIELDS:
+        if name in data: setattr(row, name, data[name])
+    db.session.commit()
+    client_keys.invalidate()
+    return jsonify({'success': True})
+
+@app.route('/api/client-keys/<int:id>', methods=['DELETE'])
+@api_auth_required
+def delete_client_key(id):
+    row = ClientKey.query.get_or_404(id)
+    db.session.delete(row)
+    db.session.commit()
+    client_keys.invalidate()
+    return jsonify({'success': True})
+
+@app.route('/api/client-keys/stats', methods=['GET'])
+@api_auth_required
+def client_keys_stats():
+    client_keys.ensure_loaded()
+    return jsonify({'success': True, 'stats': client_keys.stats()})
+
+@app.route('/api/admission/stats', methods=['GET'])
+@api_auth_required
+def admission_stats():
+    return jsonify({'success': True, 'stats': admission.queue.stats()})
+
+@app.route('/api/affinity/stats', methods=['GET'])
+@api_auth_required
+def affinity_stats():
+    return jsonify({'success': True, 'stats': affinity.stats()})
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+@api_auth_required
+def scheduler_stats():
+    stats = token_scheduler.stats()
+    for entry in stats['tokens']:
+        record = token_pool.pool.get(entry['id'])
+        if record is not None:
+            entry.update(token_latency.snapshot(record))
+    stats['latency'] = token_latency.stats()
+    return jsonify({'success': True, 'stats': stats})
+
+@app.route('/api/upstream/stats', methods=['GET'])
+@api_auth_required
+def upstream_stats():
+    return jsonify({'success': True, 'stats': upstream.client.stats()})
+
+@app.route('/api/models/stats', methods=['GET'])
+@api_auth_required
+def models_stats():
+    return jsonify({'success': True, 'stats': model_catalog.stats()})
+
+@app.route('/api/coalescer/stats', methods=['GET'])
+@api_auth_required
+def coalescer_stats():
+    return jsonify({'success': True, 'stats': coalescer.stats()})
+
+@app.route('/api/hedging/stats', methods=['GET'])
+@api_auth_required
+def hedging_stats():
+    return jsonify({'success': True, 'stats': hedging.stats()})
+
 @app.route('/update_token_info', methods=['POST'])
 def update_token_info():
     """更新 Zai Token 信息（通过 OAuth 登录）"""
@@ -612,6 +799,11 @@ def get_logs():
         'created_at': l.created_at.isoformat()
     } for l in logs])
 
+@app.route('/api/logs/writer-stats', methods=['GET'])
+@api_auth_required
+def log_writer_stats():
+    return jsonify({'success': True, 'stats': log_writer.writer.stats()})
+
 @app.route('/api/cache/config', methods=['GET', 'POST'])
 @api_auth_required
 def cache_config():
@@ -628,8 +820,20 @@ def cache_config():
         data = request.json
         if 'timeout' in data: config.cache_timeout = data['timeout']
         db.session.commit()
+        config_cache.invalidate()
         return jsonify({'success': True})
 
+@app.route('/api/cache/stats', methods=['GET'])
+@api_auth_required
+def cache_stats():
+    return jsonify({'success': True, 'stats': response_cache.cache.stats()})
+
+@app.route('/api/cache/clear', methods=['POST'])
+@api_auth_required
+def cache_clear():
+    response_cache.cache.clear()
+    return jsonify({'success': True})
+
 @app.route('/api/cache/enabled', methods=['POST'])
 @api_auth_required
 def cache_enabled():
@@ -637,6 +841,7 @@ def cache_enabled():
     config = SystemConfig.query.first()
     config.cache_enabled = data.get('enabled')
     db.session.commit()
+    config_cache.invalidate()
     return jsonify({'success': True})
 
 @app.route('/api/cache/base-url', methods=['POST'])
@@ -646,6 +851,7 @@ def cache_base_url():
     config = SystemConfig.query.first()
     config.cache_base_url = data.get('base_url')
     db.session.commit()
+    config_cache.invalidate()
     return jsonify({'success': True})
 
 @app.route('/api/generation/timeout', methods=['GET', 'POST'])
@@ -662,12 +868,13 @@ def generation_timeout():
         config.image_timeout = data.get('image_timeout')
         config.video_timeout = data.get('video_timeout')
         db.session.commit()
+        config_cache.invalidate()
         return jsonify({'success': True})
 
 @app.route('/api/token-refresh/config', methods=['GET'])
 @api_auth_required
 def token_refresh_config():
-    config = SystemConfig.query.first()
+    config = config_cache.get()
     return jsonify({'success': True, 'config': {
         'at_auto_refresh_enabled': config.at_auto_refresh_enabled
     }})
@@ -679,6 +886,7 @@ def token_refresh_enabled():
     config = SystemConfig.query.first()
     config.at_auto_refresh_enabled = data.get('enabled')
     db.session.commit()
+    config_cache.invalidate()
     return jsonify({'success': True})
 
 @app.route('/api/tokens/import', methods=['POST'])
@@ -712,7 +920,8 @@ def import_tokens():
                 image_enabled=t_data.get('image_enabled', True),
                 video_enabled=t_data.get('video_enabled', True),
                 image_concurrency=t_data.get('image_concurrency', -1),
-                video_concurrency=t_data.get('video_concurrency', -1)
+                video_concurrency=t_data.get('video_concurrency', -1),
+                weight=t_data.get('weight', 1)
             )
             db.session.add(token)
             added += 1
@@ -746,34 +955,62 @@ def activate_sora2(id):
 
 # --- OpenAI Compatible Proxy ---
 
-_rr_lock = Lock()
-_rr_index = 0
-
-def _get_token_candidates():
-    """多号轮询：每个请求从上一次的下一个 token 开始顺序尝试。"""
-    global _rr_index
-    tokens = Token.query.filter_by(is_active=True).order_by(Token.id.asc()).all()
-    valid_tokens = [t for t in tokens if t.zai_token and not str(t.zai_token).startswith('SESSION')]
-    if not valid_tokens:
-        return []
-    with _rr_lock:
-        start = _rr_index % len(valid_tokens)
-        _rr_index = (start + 1) % len(valid_tokens)
-    return valid_tokens[start:] + valid_tokens[:start]
-
-def _mark_token_error(token: Token, config: SystemConfig, reason: str):
-    token.error_count = int(token.error_count or 0) + 1
-    token.remark = (reason or '')[:1000]
-    threshold = int(getattr(config, 'error_ban_threshold', 3) or 3)
-    if token.error_count >= threshold:
-        token.is_active = False
-        token.remark = f"Auto-banned due to errors: {(reason or '')[:950]}"
-    db.session.commit()
+def _authenticate(config: config_cache.ConfigSnapshot | None) -> client_keys.ClientState | None:
+    """校验 Bearer Key：调用方 Key 或系统 API Key，返回对应的客户端。"""
+    auth_header = request.headers.get('Authorization')
+    if config is None or not auth_header or not auth_header.startswith('Bearer '):
+        return None
+    return client_keys.authenticate(config, auth_header.split(' ')[1])
+
+def _get_token_candidates(kind: str, limit: int, model: str | None = None, priority: str = token_scheduler.PRIORITY_HIGH):
+    """按配置的选号策略（默认多号轮询）给出候选 token，跳过已达并发上限的及不支持该模型的（只读内存 token 池）；
+    低优先级请求只选还有预留之外余量的 token。"""
+    return token_scheduler.select(kind, limit, model, priority)
+
+def _claim_token(kind: str, limit: int, model: str | None = None, priority: str = token_scheduler.PRIORITY_HIGH,
+                 sticky=None):
+    """选号并占用第一个能占到并发名额的候选；返回 (lease, 其余候选)，都占不到时返回 None。
+    sticky 为已经占到的对话粘滞 token 的名额，直接使用，其余候选仍按选号策略给出。"""
+    candidates = _get_token_candidates(kind, limit, model, priority)
+    if sticky is not None:
+        return sticky, [t for t in candidates if t is not sticky.record][:limit - 1]
+    for i, token in enumerate(candidates):
+        lease = token_scheduler.acquire(token, kind, priority)
+        if lease is not None:
+            return lease, candidates[i + 1:]
+    return None
 
-def _mark_token_success(token: Token):
-    if token.error_count:
-        token.error_count = 0
-    db.session.commit()
+def _no_token_response():
+    response = jsonify({'error': 'No active tokens available'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(admission.retry_after())
+    return response
+
+def _mark_token_error(record: token_pool.TokenRecord, config: config_cache.ConfigSnapshot, reason: str, status_code: int | None = None):
+    if status_code in circuit_breaker.AUTH_FAILURE_STATUS:
+        # 认证失败不会自愈，直接永久禁用
+        token_health.mark_error(record, reason, ban=True)
+        logger.warning(f"Token {record.id} banned after HTTP {status_code}")
+        return
+    token_health.mark_error(record, reason)
+    threshold = int(getattr(config, 'error_ban_threshold', 3) or 3)
+    if circuit_breaker.record_failure(record, threshold):
+        logger.warning(f"Token {record.id} circuit opened, retry in {record.cb_open_until - time.monotonic():.0f}s")
+
+def _mark_token_success(record: token_pool.TokenRecord):
+    token_health.mark_success(record)
+    circuit_breaker.record_success(record)
+
+def _log_request(operation: str, record: token_pool.TokenRecord, status_code: int, duration: float):
+    """请求日志交给后台线程批量写入，不阻塞响应。"""
+    log_writer.writer.submit(
+        operation=operation,
+        token_email=record.email,
+        discord_token=_mask_token(record.discord_token),
+        zai_token=_mask_token(record.zai_token),
+        status_code=status_code,
+        duration=duration
+    )
 
 def _filter_stream_headers(hdrs):
     out = {}
@@ -783,101 +1020,106 @@ def _filter_stream_headers(hdrs):
     out.setdefault('Content-Type', 'text/event-stream')
     return out
 
-def _aggregate_sse_to_nonstream(resp, fallback_model: str | None = None):
-    first_chunk = None
-    usage = None
-    role_by_index: dict[int, str] = {}
-    content_by_index: dict[int, list[str]] = {}
-    finish_by_index: dict[int, str] = {}
-
-    for line in resp.iter_lines(decode_unicode=True):
-        if not line:
-            continue
-        if not line.startswith('data:'):
-            continue
-        data = line[5:].strip()
-        if not data:
-            continue
-        if data == '[DONE]':
-            break
-        try:
-            chunk = json.loads(data)
-        except Exception:
-            continue
-        if first_chunk is None:
-            first_chunk = chunk
-        if isinstance(chunk, dict) and chunk.get('usage'):
-            usage = chunk.get('usage')
-        for choice in (chunk.get('choices') or []):
-            idx = int(choice.get('index', 0))
-            delta = choice.get('delta') or {}
-            if delta.get('role'):
-                role_by_index[idx] = delta['role']
-            if 'content' in delta and delta['content'] is not None:
-                content_by_index.setdefault(idx, []).append(delta['content'])
-            if choice.get('finish_reason') is not None:
-                finish_by_index[idx] = choice.get('finish_reason')
-
-    created = (first_chunk or {}).get('created') or int(time.time())
-    model = (first_chunk or {}).get('model') or fallback_model or 'unknown'
-    rid = (first_chunk or {}).get('id') or f"chatcmpl-{int(time.time()*1000)}"
-
-    indexes = sorted(content_by_index.keys()) if content_by_index else [0]
-    choices_out = []
-    for idx in indexes:
-        choices_out.append({
-            'index': idx,
-            'message': {
-                'role': role_by_index.get(idx, 'assistant'),
-                'content': ''.join(content_by_index.get(idx, []))
-            },
-            'finish_reason': finish_by_index.get(idx, 'stop')
-        })
-
-    out = {
-        'id': rid,
-        'object': 'chat.completion',
-        'created': created,
-        'model': model,
-        'choices': choices_out
-    }
-    if usage is not None:
-        out['usage'] = usage
-    return out
-
 @app.route('/v1/chat/completions', methods=['POST'])
 def proxy_chat_completions():
-    start_time = time.time()
-    
     # Verify API Key
-    config = SystemConfig.query.first()
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer ') or auth_header.split(' ')[1] != config.api_key:
+    config = config_cache.get()
+    client = _authenticate(config)
+    if client is None:
          return jsonify({'error': 'Invalid API Key'}), 401
 
-    payload = request.get_json(silent=True)
-    if not isinstance(payload, dict):
+    # 请求体大小受 MAX_CONTENT_LENGTH 限制，超出时 get_data 抛出 413
+    raw = request.get_data(cache=False)
+    try:
+        payload = request_body.parse(raw)
+    except request_body.InvalidBody:
         return jsonify({'error': 'Invalid JSON body'}), 400
 
+    # 按调用方 Key 的限额放行；响应体转发完毕后归还名额并记录用量
+    priority = client_keys.resolve_priority(client, request.headers.get(client_keys.PRIORITY_HEADER))
+    ticket, reason, retry_after = client_keys.admit(client, priority, bool(payload.get('stream')), len(raw))
+    if ticket is None:
+        response = jsonify({'error': f"Rate limit exceeded for API key '{client.name}': {reason}"})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+    try:
+        response = app.make_response(_coalesce_chat_completions(config, payload, raw, ticket))
+    except BaseException:
+        ticket.finish()
+        raise
+    return client_keys.meter(ticket, response)
+
+def _coalesce_chat_completions(config, payload: dict, raw: bytes, ticket: client_keys.Ticket):
+    """合并相同的并发请求：后到的请求跟随第一个请求的响应。"""
+    key = coalescer.flight_key(payload, request.headers, ticket.client.id)
+    if key is None:
+        return _proxy_chat_completions(config, payload, raw, ticket)
+    flight, leader = coalescer.join(key)
+    if not leader:
+        followed = coalescer.follow(flight)
+        if followed is None:
+            return _proxy_chat_completions(config, payload, raw, ticket)
+        status, headers, body = followed
+        return Response(body, status=status, headers=headers)
+    try:
+        response = app.make_response(_proxy_chat_completions(config, payload, raw, ticket))
+    except BaseException:
+        coalescer.abort(flight)
+        raise
+    return coalescer.lead(flight, response)
+
+def _proxy_chat_completions(config, payload: dict, raw: bytes, ticket: client_keys.Ticket):
+    start_time = time.time()
+
     client_stream = bool(payload.get('stream'))
     stream_conversion_enabled = bool(getattr(config, 'stream_conversion_enabled', False))
     should_convert = (not client_stream) and stream_conversion_enabled
     zai_stream = client_stream or should_convert
 
-    candidates = _get_token_candidates()
-    if not candidates:
-        return jsonify({'error': 'No active tokens available'}), 503
-
+    # 确定性请求的响应缓存
+    cache_key = response_cache.cache_key(payload, request.headers, ticket.client.id) if getattr(config, 'cache_enabled', False) else None
+    cache_ttl = int(getattr(config, 'cache_timeout', 0) or 0)
+    if cache_key:
+        cached = response_cache.cache.get(cache_key)
+        if cached is not None:
+            if client_stream:
+                return Response(stream_with_context(sse.synthesize_body(cached)), headers={
+                    'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Cache': 'HIT'})
+            return Response(cached, mimetype='application/json', headers={'X-Cache': 'HIT'})
+
+    def stream_response(body, status, headers):
+        if cache_key:
+            body = response_cache.record_stream(body, cache_key, cache_ttl)
+        return Response(stream_with_context(body), status=status, headers=headers)
+
+    # 转发名额用满时按调用方权重公平排队
+    if not ticket.wait_slot():
+        response = jsonify({'error': 'Server busy, please retry later'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+
+    kind = token_scheduler.request_kind(payload.get('model'))
     max_attempts = max(1, int(getattr(config, 'error_retry_count', 1) or 1))
-    attempts = 0
-    last_response = None
-
-    for token in candidates:
-        if attempts >= max_attempts:
-            break
-        attempts += 1
-
-        zai_url = "https://zai.is/api/v1/chat/completions"
+    priority = ticket.priority
+    # 对话粘滞 token 每个请求只查一次；排队重试时按正常选号处理
+    affinity_key = affinity.key_for(payload, request.headers, ticket.client)
+    sticky = affinity.claim(affinity_key, kind, payload.get('model'), priority) if affinity_key else None
+    claimed = _claim_token(kind, max_attempts, payload.get('model'), priority, sticky)
+    if claimed is None and settings.ADMISSION_QUEUE_MAX > 0 and len(token_pool.pool):
+        # 所有 token 都在忙或冷却中：排队等待名额，而不是立即 503
+        claimed, _ = admission.queue.wait(
+            lambda: _claim_token(kind, max_attempts, payload.get('model'), priority), admission.rank_of(ticket.client, priority))
+    if claimed is None:
+        return _no_token_response()
+    first_lease, candidates = claimed
+
+    # 原样转发客户端的请求体，只在需要改为流式时改写 stream 字段
+    zai_body = request_body.with_stream(raw, payload) if zai_stream else raw
+
+    def sender(token, body=None):
+        body = zai_body if body is None else sse.dumps(body)
         headers = {
             "Authorization": f"Bearer {token.zai_token}",
             "Content-Type": "application/json"
@@ -885,76 +1127,231 @@ def proxy_chat_completions():
         # 添加 x-zai-darkknight 请求头
         if token.zai_darkknight:
             headers["x-zai-darkknight"] = token.zai_darkknight
+        # 总是以 stream=True 读取：先拿到首个数据块再决定是否把响应交给客户端。
+        # 非流式上游要生成完整回答才返回首字节，不适用 TTFB 期限
+        first_byte = settings.UPSTREAM_TTFB_TIMEOUT if zai_stream else settings.UPSTREAM_READ_TIMEOUT
+        timeout = (settings.UPSTREAM_CONNECT_TIMEOUT, first_byte)
+        return lambda: upstream.client.post('/api/v1/chat/completions', data=body, headers=headers, stream=True, timeout=timeout)
 
-        zai_payload = dict(payload)
-        if zai_stream:
-            zai_payload['stream'] = True
+    # 非流式响应在客户端接受时原样转发上游的压缩数据（需要缓存时要解压后的内容）
+    passthrough = frozenset() if zai_stream or cache_key else proxy_attempt.accepted_encodings(request.headers.get('Accept-Encoding'))
 
-        try:
-            resp = requests.post(zai_url, json=zai_payload, headers=headers, stream=zai_stream, timeout=600)
-        except Exception as e:
-            _mark_token_error(token, config, f"Request error: {e}")
-            last_response = jsonify({'error': str(e)})
-            last_response.status_code = 502
-            continue
+    remaining = iter(candidates)
+    attempts = 0
 
-        # Log request (UI 展示用，写入脱敏 token)
-        duration = time.time() - start_time
-        log = RequestLog(
-            operation="chat/completions",
-            token_email=token.email,
-            discord_token=_mask_token(token.discord_token),
-            zai_token=_mask_token(token.zai_token),
-            status_code=resp.status_code,
-            duration=duration
-        )
-        db.session.add(log)
-        db.session.commit()
+    def make_attempt(lease):
+        if zai_stream:
+            return proxy_attempt.Attempt(lease.record, lease, idle_timeout=settings.UPSTREAM_IDLE_TIMEOUT)
+        return proxy_attempt.Attempt(lease.record, lease, chunk_size=proxy_attempt.RELAY_CHUNK_SIZE, passthrough=passthrough)
 
-        if resp.status_code >= 400:
-            try:
-                detail = resp.text
-            except Exception:
-                detail = ''
+    def next_attempt():
+        """取下一个能占到并发名额的候选 token（第一个已在选号时占好）。"""
+        nonlocal attempts, first_lease
+        if attempts >= max_attempts:
+            return None
+        if first_lease is not None:
+            lease, first_lease = first_lease, None
+            attempts += 1
+            return make_attempt(lease)
+        for token in remaining:
+            lease = token_scheduler.acquire(token, kind, priority)
+            if lease is None:
+                # 选号后被其他请求占满了并发名额
+                continue
+            attempts += 1
+            return make_attempt(lease)
+        return None
+
+    def fail(attempt):
+        """处理一次失败的尝试，返回给客户端的兜底响应。"""
+        token = attempt.token
+        try:
+            if attempt.error is not None:
+                if attempt.timeout:
+                    logger.warning(f"Token {token.id} {attempt.timeout} timeout, trying next token")
+                _mark_token_error(token, config, f"Request error: {attempt.error}")
+                response = jsonify({'error': str(attempt.error)})
+                response.status_code = 502
+                return response
+            resp = attempt.resp
+            # Log request (UI 展示用，写入脱敏 token)
+            _log_request("chat/completions", token, resp.status_code, time.time() - start_time)
+            cooldown = rate_limits.observe(token, resp.status_code, resp.headers)
+            if resp.status_code in adaptive_limit.OVERLOAD_STATUS:
+                adaptive_limit.on_overload(token)
+            # 错误响应体只保留有限长度，供日志和最后一次失败的兜底响应使用
+            body = attempt.error_body(settings.UPSTREAM_ERROR_BODY_MAX)
+            detail = body[:200].decode('utf-8', errors='replace')
             # 429 (Too Many Requests) 是速率限制，不计入错误，只尝试下一个token
             if resp.status_code != 429:
-                _mark_token_error(token, config, f"HTTP {resp.status_code}: {detail[:200]}")
+                _mark_token_error(token, config, f"HTTP {resp.status_code}: {detail}", resp.status_code)
             else:
-                logger.info(f"Token {token.id} hit rate limit (429), trying next token")
-            last_response = Response(resp.content, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
+                logger.info(f"Token {token.id} hit rate limit (429), cooling down for {cooldown:.0f}s, trying next token")
+            return Response(body, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
+        finally:
+            attempt.close()
+
+    def settle(attempt):
+        """被取消的对冲尝试：上游已经给出的状态仍计入日志、限流、自适应上限和熔断。"""
+        resp = attempt.resp
+        if resp is None:
+            # 没拿到响应头（多半是取消时断开的连接），不算 token 的错误
+            return
+        token = attempt.token
+        _log_request("chat/completions", token, resp.status_code, time.time() - start_time)
+        rate_limits.observe(token, resp.status_code, resp.headers)
+        if resp.status_code in adaptive_limit.OVERLOAD_STATUS:
+            adaptive_limit.on_overload(token)
+        if resp.status_code < 400:
+            _mark_token_success(token)
+        elif resp.status_code != 429:
+            _mark_token_error(token, config, f"HTTP {resp.status_code} (hedged attempt cancelled)", resp.status_code)
+
+    hedge_allowed = settings.HEDGE_ENABLED and kind == token_scheduler.KIND_CHAT and max_attempts > 1
+    if hedge_allowed:
+        hedging.note_request()
+
+    last_response = None
+    while True:
+        attempt = next_attempt()
+        if attempt is None:
+            break
+
+        delay = hedging.hedge_delay(zai_stream) if hedge_allowed else None
+        if delay is not None:
+            def make_backup():
+                backup = next_attempt()
+                return (backup, sender(backup.token)) if backup is not None else None
+            attempt, failed = hedging.race(attempt, sender(attempt.token), delay, make_backup, settle)
+            for other in failed:
+                last_response = fail(other)
+        else:
+            attempt.open(sender(attempt.token))
+
+        if not attempt.ok:
+            last_response = fail(attempt)
             continue
 
+        token = attempt.token
+        resp = attempt.resp
+        hedging.record_ttfb(zai_stream, attempt.ttfb)
+        adaptive_limit.on_success(token, attempt.ttfb if zai_stream else None)
+        _log_request("chat/completions", token, resp.status_code, time.time() - start_time)
+        rate_limits.observe(token, resp.status_code, resp.headers)
         _mark_token_success(token)
+        if affinity_key:
+            affinity.remember(affinity_key, token.id)
+
+        if client_stream and 'json' in resp.headers.get('Content-Type', '').lower():
+            # 上游对流式请求返回了单个 JSON：合成 SSE 数据块给客户端
+            def generate(attempt=attempt):
+                try:
+                    yield from sse.synthesize_body(b''.join(attempt.body()))
+                finally:
+                    attempt.close()
+            headers = {'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'}
+            return stream_response(generate(), resp.status_code, headers)
+
+        if client_stream and settings.STREAM_RESUME_ENABLED:
+            def reopen(broken, partial):
+                """上游流中途断开：换一个 token，以已输出内容为前缀续写。"""
+                _mark_token_error(broken.token, config, f"Stream broken: {broken.broken}")
+                body = stream_resume.continuation_payload(dict(payload, stream=True), partial)
+                for candidate in _get_token_candidates(kind, max_attempts + 1, payload.get('model'), priority):
+                    if candidate.id == broken.token.id:
+                        continue
+                    lease = token_scheduler.acquire(candidate, kind, priority)
+                    if lease is None:
+                        continue
+                    resumed = proxy_attempt.Attempt(candidate, lease, idle_timeout=settings.UPSTREAM_IDLE_TIMEOUT)
+                    resumed.open(sender(candidate, body))
+                    if not resumed.ok:
+                        fail(resumed)
+                        continue
+                    logger.info(f"Resumed broken stream of token {broken.token.id} on token {candidate.id} after {len(partial)} chars")
+                    _log_request("chat/completions/resume", candidate, resumed.resp.status_code, time.time() - start_time)
+                    rate_limits.observe(candidate, resumed.resp.status_code, resumed.resp.headers)
+                    _mark_token_success(candidate)
+                    return resumed
+                logger.warning(f"Could not resume broken stream of token {broken.token.id}: no token available")
+                return None
+
+            generate = stream_resume.resumable(attempt, reopen, settings.STREAM_RESUME_MAX)
+            return stream_response(generate, resp.status_code, _filter_stream_headers(resp.headers))
 
         if client_stream:
-            def generate():
-                for chunk in resp.iter_content(chunk_size=1024):
-                    if chunk:
-                        yield chunk
-            return Response(stream_with_context(generate()), status=resp.status_code, headers=_filter_stream_headers(resp.headers))
+            def generate(attempt=attempt):
+                try:
+                    yield from attempt.body()
+                finally:
+                    # 客户端中途断开时也要归还上游连接和并发名额
+                    attempt.close()
+            return stream_response(generate(), resp.status_code, _filter_stream_headers(resp.headers))
 
         if should_convert:
-            aggregated = _aggregate_sse_to_nonstream(resp, fallback_model=payload.get('model'))
+            try:
+                aggregated = sse.aggregate(attempt.body(), fallback_model=payload.get('model'))
+            except sse.AggregateTooLarge as e:
+                logger.warning(f"Stream conversion aborted for token {token.id}: {e}")
+                return jsonify({'error': str(e)}), 502
+            finally:
+                attempt.close()
+            if cache_key:
+                response_cache.cache.put_completion(cache_key, aggregated, cache_ttl)
             return jsonify(aggregated)
 
-        return Response(resp.content, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
+        # 非流式响应逐块转发，不在内存中拼出完整响应体
+        def relay(attempt=attempt):
+            try:
+                yield from attempt.body()
+            finally:
+                attempt.close()
+        headers = {'Content-Type': resp.headers.get('Content-Type', 'application/json')}
+        if attempt.encoding:
+            headers['Content-Encoding'] = attempt.encoding
+            headers['Vary'] = 'Accept-Encoding'
+        if resp.headers.get('Content-Length') and (attempt.encoding or not resp.headers.get('Content-Encoding')):
+            # 原样转发的字节数与上游一致；解压后的长度未知，改用分块传输
+            headers['Content-Length'] = resp.headers['Content-Length']
+        body = relay()
+        if cache_key:
+            body = response_cache.record_body(body, cache_key, cache_ttl)
+        return Response(stream_with_context(body), status=resp.status_code, headers=headers)
 
     if last_response is not None:
         return last_response
-    return jsonify({'error': 'No active tokens available'}), 503
+    return _no_token_response()
 
 @app.route('/v1/models', methods=['GET'])
 def proxy_models():
-    # Proxy or return static
     # Verify API Key
-    config = SystemConfig.query.first()
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or not auth_header.startswith('Bearer ') or auth_header.split(' ')[1] != config.api_key:
+    config = config_cache.get()
+    if _authenticate(config) is None:
          return jsonify({'error': 'Invalid API Key'}), 401
 
+    # 优先返回缓存的模型目录；过期时先返回旧数据，后台刷新
+    catalog = model_catalog.get()
+    if catalog is None:
+        fetched = _fetch_models(config)
+        if not isinstance(fetched, model_catalog.Catalog):
+            return fetched
+        catalog = fetched
+        # 首次只用一个 token 取到了列表，后台继续发现其余 token 的模型
+        model_catalog.refresh_async()
+    elif catalog.stale:
+        model_catalog.refresh_async()
+
+    response = Response(catalog.body, mimetype='application/json')
+    response.set_etag(catalog.etag)
+    response.headers['Cache-Control'] = f"private, max-age={int(settings.MODELS_CACHE_TTL)}"
+    return response.make_conditional(request)
+
+def _fetch_models(config):
+    """缓存为空时同步向上游请求一次；成功返回 Catalog，否则返回给客户端的响应。"""
     start_time = time.time()
 
-    candidates = _get_token_candidates()
+    max_attempts = max(1, int(getattr(config, 'error_retry_count', 1) or 1))
+    candidates = _get_token_candidates(token_scheduler.KIND_CHAT, max_attempts)
     if not candidates: # If no token, maybe we can't fetch models? Or just return default list.
         # Fallback list
         return jsonify({
@@ -965,56 +1362,55 @@ def proxy_models():
             ]
         })
 
-    max_attempts = max(1, int(getattr(config, 'error_retry_count', 1) or 1))
     attempts = 0
     last_response = None
 
     for token in candidates:
         if attempts >= max_attempts:
             break
+        lease = token_scheduler.acquire(token, token_scheduler.KIND_CHAT)
+        if lease is None:
+            continue
         attempts += 1
 
-        zai_url = "https://zai.is/api/v1/models"
-        headers = {"Authorization": f"Bearer {token.zai_token}"}
-        # 添加 x-zai-darkknight 请求头
-        if token.zai_darkknight:
-            headers["x-zai-darkknight"] = token.zai_darkknight
-
         try:
-            resp = requests.get(zai_url, headers=headers, timeout=60)
-        except Exception as e:
-            _mark_token_error(token, config, f"Request error: {e}")
-            last_response = jsonify({"error": "Failed to fetch models", "detail": str(e)})
-            last_response.status_code = 502
-            continue
+            headers = {"Authorization": f"Bearer {token.zai_token}"}
+            # 添加 x-zai-darkknight 请求头
+            if token.zai_darkknight:
+                headers["x-zai-darkknight"] = token.zai_darkknight
 
-        duration = time.time() - start_time
-        log = RequestLog(
-            operation="models",
-            token_email=token.email,
-            discord_token=_mask_token(token.discord_token),
-            zai_token=_mask_token(token.zai_token),
-            status_code=resp.status_code,
-            duration=duration
-        )
-        db.session.add(log)
-        db.session.commit()
-
-        if resp.status_code >= 400:
             try:
-                detail = resp.text
-            except Exception:
-                detail = ''
-            # 429 (Too Many Requests) 是速率限制，不计入错误，只尝试下一个token
-            if resp.status_code != 429:
-                _mark_token_error(token, config, f"HTTP {resp.status_code}: {detail[:200]}")
-            else:
-                logger.info(f"Token {token.id} hit rate limit (429), trying next token")
-            last_response = Response(resp.content, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
-            continue
+                resp = upstream.client.get('/api/v1/models', headers=headers, timeout=(settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_TTFB_TIMEOUT))
+            except Exception as e:
+                _mark_token_error(token, config, f"Request error: {e}")
+                last_response = jsonify({"error": "Failed to fetch models", "detail": str(e)})
+                last_response.status_code = 502
+                continue
 
-        _mark_token_success(token)
-        return Response(resp.content, status=resp.status_code, mimetype='application/json')
+            _log_request("models", token, resp.status_code, time.time() - start_time)
+            cooldown = rate_limits.observe(token, resp.status_code, resp.headers)
+
+            if resp.status_code >= 400:
+                try:
+                    detail = resp.text
+                except Exception:
+                    detail = ''
+                # 429 (Too Many Requests) 是速率限制，不计入错误，只尝试下一个token
+                if resp.status_code != 429:
+                    _mark_token_error(token, config, f"HTTP {resp.status_code}: {detail[:200]}", resp.status_code)
+                else:
+                    logger.info(f"Token {token.id} hit rate limit (429), cooling down for {cooldown:.0f}s, trying next token")
+                last_response = Response(resp.content, status=resp.status_code, mimetype=resp.headers.get('Content-Type', 'application/json'))
+                continue
+
+            _mark_token_success(token)
+            catalog = model_catalog.ingest(token, resp.content)
+            if catalog is None:
+                # 无法解析的响应原样返回，不缓存
+                return Response(resp.content, status=resp.status_code, mimetype='application/json')
+            return catalog
+        finally:
+            lease.release()
 
     if last_response is not None:
         return last_response
@@ -1022,6 +1418,8 @@ def proxy_models():
 
 # Initialize database on startup (works with both Gunicorn and direct Python execution)
 init_db()
+log_writer.writer.init_app(app)
+upstream.client.prewarm_async(settings.UPSTREAM_POOL_PREWARM)
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True, use_reloader=False) # use_reloader=False for scheduler
@@ -0,0 +1,76 @@
+"""请求体转发的微基准：对比旧路径（get_json + dict 复制 + requests 的 json= 重新序列化）
+与原样转发原始字节（request_body），统计每个请求的 CPU 时间和峰值内存。
+
+用法：
+    python bench_forward.py              # 5 MB 的多模态请求体
+    python bench_forward.py --mb 20 --rounds 10
+"""
+import argparse
+import base64
+import json
+import os
+import time
+import tracemalloc
+
+import request_body
+
+
+def make_body(megabytes: float) -> bytes:
+    image = base64.b64encode(os.urandom(int(megabytes * 1024 * 1024 * 3 / 4))).decode('ascii')
+    payload = {
+        'model': 'bench',
+        'messages': [{
+            'role': 'user',
+            'content': [
+                {'type': 'text', 'text': '描述这张图片'},
+                {'type': 'image_url', 'image_url': {'url': f'data:image/png;base64,{image}'}},
+            ],
+        }],
+    }
+    return json.dumps(payload, ensure_ascii=False).encode('utf-8')
+
+
+def legacy_forward(raw: bytes, convert: bool) -> bytes:
+    payload = json.loads(raw.decode('utf-8'))
+    zai_payload = dict(payload)
+    if convert:
+        zai_payload['stream'] = True
+    # requests 对 json= 的处理：complexjson.dumps 后编码为 UTF-8
+    return json.dumps(zai_payload, allow_nan=False).encode('utf-8')
+
+
+def raw_forward(raw: bytes, convert: bool) -> bytes:
+    payload = request_body.parse(raw)
+    return request_body.with_stream(raw, payload) if convert else raw
+
+
+def measure(fn, raw: bytes, convert: bool, rounds: int):
+    cpu = []
+    for _ in range(rounds):
+        started = time.process_time()
+        fn(raw, convert)
+        cpu.append(time.process_time() - started)
+    tracemalloc.start()
+    fn(raw, convert)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(cpu), peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mb', type=float, default=5)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    raw = make_body(args.mb)
+    print(f"body: {len(raw) / 1e6:.1f} MB, json backend: {'orjson' if request_body.sse.orjson else 'json'}")
+    for convert in (False, True):
+        label = 'stream rewrite' if convert else 'pass-through'
+        for name, fn in (('legacy', legacy_forward), ('raw', raw_forward)):
+            cpu, peak = measure(fn, raw, convert, args.rounds)
+            print(f"{label:<15} {name:<7} cpu {cpu * 1000:7.2f} ms   peak {peak / 1e6:7.2f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""流式转非流式聚合的微基准：对比旧实现（按文本行 + json.loads）与 sse.aggregate。
+
+用法：
+    python bench_sse.py                 # 生成 20000 个数据块的模拟流
+    python bench_sse.py --chunks 100000
+    python bench_sse.py --file stream.txt   # 使用录制的上游 SSE 原文
+    python bench_sse.py --long-line 4000000 # 单个很长的 data 行（大段工具调用参数 / base64 图片）
+"""
+import argparse
+import json
+import time
+
+import sse
+
+
+def legacy_aggregate(chunks, fallback_model=None):
+    """原 _aggregate_sse_to_nonstream 的逻辑（逐行解码为 str 后 json.loads）。"""
+    pending = b''
+    lines = []
+    for chunk in chunks:
+        pending += chunk
+        *complete, pending = pending.split(b'\n')
+        lines.extend(line.rstrip(b'\r').decode('utf-8', errors='replace') for line in complete)
+    if pending:
+        lines.append(pending.decode('utf-8', errors='replace'))
+
+    first_chunk = None
+    content_by_index = {}
+    for line in lines:
+        if not line.startswith('data:'):
+            continue
+        data = line[5:].strip()
+        if not data:
+            continue
+        if data == '[DONE]':
+            break
+        try:
+            chunk = json.loads(data)
+        except Exception:
+            continue
+        if first_chunk is None:
+            first_chunk = chunk
+        for choice in (chunk.get('choices') or []):
+            delta = choice.get('delta') or {}
+            if delta.get('content') is not None:
+                content_by_index.setdefault(int(choice.get('index', 0)), []).append(delta['content'])
+    return {i: ''.join(parts) for i, parts in content_by_index.items()}
+
+
+def synthetic_stream(count: int) -> bytes:
+    out = []
+    for i in range(count):
+        chunk = {
+            'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': 1, 'model': 'bench',
+            'choices': [{'index': 0, 'delta': {'content': f'token{i} 中文 '}, 'finish_reason': None}],
+        }
+        out.append(b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b'\n\n')
+    out.append(b'data: [DONE]\n\n')
+    return b''.join(out)
+
+
+def long_line_stream(size: int) -> bytes:
+    """一个很长的工具调用参数事件，按读取大小切开后每块都不含换行。"""
+    chunk = {
+        'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': 1, 'model': 'bench',
+        'choices': [{'index': 0, 'delta': {'tool_calls': [
+            {'index': 0, 'id': 'call_0', 'type': 'function', 'function': {'name': 'f', 'arguments': 'x' * size}}]},
+            'finish_reason': None}],
+    }
+    return b'data: ' + json.dumps(chunk).encode('utf-8') + b'\n\ndata: [DONE]\n\n'
+
+
+def split(raw: bytes, size: int):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def bench(name, fn, pieces, rounds):
+    best = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        fn(iter(pieces))
+        best = min(best, time.perf_counter() - started)
+    total = sum(len(p) for p in pieces)
+    print(f"{name:<10} {best * 1000:8.1f} ms  {total / best / 1e6:8.1f} MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--file')
+    parser.add_argument('--long-line', type=int, default=0)
+    parser.add_argument('--read-size', type=int, default=1024)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.file:
+        raw = open(args.file, 'rb').read()
+    elif args.long_line:
+        raw = long_line_stream(args.long_line)
+    else:
+        raw = synthetic_stream(args.chunks)
+    pieces = split(raw, args.read_size)
+    print(f"stream: {len(raw) / 1e6:.1f} MB in {len(pieces)} reads, json backend: {'orjson' if sse.orjson else 'json'}")
+    bench('legacy', legacy_aggregate, pieces, args.rounds)
+    bench('sse', lambda chunks: sse.aggregate(chunks, max_chars=0), pieces, args.rounds)
+
+
+if __name__ == '__main__':
+    main()
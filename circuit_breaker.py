@@ -0,0 +1,108 @@
+"""按 token 的熔断器，替代“错误达到阈值就永久禁用”。
+
+closed    正常选号；滑动窗口内错误率过高或连续失败达到 error_ban_threshold 时 -> open
+open      不参与选号；退避期（指数增长）结束后允许一个探测请求 -> half_open
+half_open 只放行这一个探测请求：成功 -> closed，失败 -> open 并加倍退避
+
+永久禁用（is_active = False）只用于 401/403 这类认证失败。状态只保存在内存中。
+"""
+import time
+from threading import Lock
+
+import settings
+from token_pool import TokenRecord
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+AUTH_FAILURE_STATUS = (401, 403)
+
+_lock = Lock()
+
+
+def allows(record: TokenRecord) -> bool:
+    state = record.cb_state
+    if state == CLOSED:
+        return True
+    if state == OPEN:
+        return time.monotonic() >= record.cb_open_until
+    return not record.cb_probe_in_flight
+
+
+def claim(record: TokenRecord) -> bool:
+    """选中 token 时调用；若本次请求是熔断后的探测请求返回 True。"""
+    with _lock:
+        if record.cb_state == CLOSED:
+            return False
+        record.cb_state = HALF_OPEN
+        record.cb_probe_in_flight = True
+        return True
+
+
+def release_probe(record: TokenRecord):
+    """探测请求结束但没有给出成功/失败结论（如 429）时，允许下一次探测。"""
+    with _lock:
+        record.cb_probe_in_flight = False
+
+
+def _error_rate(record: TokenRecord, now: float) -> tuple[int, float]:
+    window = record.cb_window
+    horizon = now - settings.CIRCUIT_WINDOW_SECONDS
+    while window and window[0][0] < horizon:
+        window.popleft()
+    total = len(window)
+    if total == 0:
+        return 0, 0.0
+    failures = sum(1 for _, ok in window if not ok)
+    return total, failures / total
+
+
+def _open(record: TokenRecord, now: float):
+    record.cb_open_count += 1
+    backoff = settings.CIRCUIT_BASE_BACKOFF * (2 ** (record.cb_open_count - 1))
+    record.cb_state = OPEN
+    record.cb_open_until = now + min(backoff, settings.CIRCUIT_MAX_BACKOFF)
+    record.cb_probe_in_flight = False
+
+
+def record_success(record: TokenRecord):
+    now = time.monotonic()
+    with _lock:
+        record.cb_window.append((now, True))
+        record.cb_consecutive_failures = 0
+        if record.cb_state != CLOSED:
+            record.cb_state = CLOSED
+            record.cb_open_count = 0
+            record.cb_probe_in_flight = False
+            record.cb_window.clear()
+
+
+def record_failure(record: TokenRecord, consecutive_threshold: int) -> bool:
+    """记录一次失败；若因此熔断（open）返回 True。"""
+    now = time.monotonic()
+    with _lock:
+        record.cb_window.append((now, False))
+        record.cb_consecutive_failures += 1
+        if record.cb_state == HALF_OPEN:
+            _open(record, now)
+            return True
+        if record.cb_state == OPEN:
+            return False
+        total, rate = _error_rate(record, now)
+        if (record.cb_consecutive_failures >= consecutive_threshold
+                or (total >= settings.CIRCUIT_MIN_REQUESTS and rate >= settings.CIRCUIT_ERROR_RATE)):
+            _open(record, now)
+            return True
+        return False
+
+
+def snapshot(record: TokenRecord) -> dict:
+    with _lock:
+        total, rate = _error_rate(record, time.monotonic())
+    return {
+        'circuit_state': record.cb_state,
+        'circuit_retry_in': round(max(0.0, record.cb_open_until - time.monotonic()), 1) if record.cb_state == OPEN else 0.0,
+        'window_requests': total,
+        'window_error_rate': round(rate, 3),
+    }
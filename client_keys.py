@@ -0,0 +1,299 @@
+"""调用方 API Key 与按 Key 的限额（纯内存执行）。
+
+- ClientKey 表中的 Key 按 SHA-256 摘要缓存在字典里，校验是一次 O(1) 查找；管理接口修改后
+  调用 invalidate()，下次请求时重新加载（已有 Key 的令牌桶和用量保留）；
+- SystemConfig.api_key 仍然可用，作为不限额的 default 客户端；
+- 每秒请求数（rps / burst）和每分钟 token 数（tpm）用令牌桶限制，同时进行的流式请求数
+  用计数限制，超出时返回 429 和 Retry-After；
+- tpm 在响应结束后按实际用量记账（响应中的 usage.total_tokens，没有时按字节数估算），
+  桶内余额为负时拒绝新请求直到回补；
+- 转发名额用满时按 weight 加权公平排队（fair_queue）；
+- 优先级：Key 设置了 priority 时以它为上限，请求头 X-Priority 只能调低；未设置时取请求头，
+  都没有时为 PRIORITY_DEFAULT。
+"""
+import hashlib
+import math
+import re
+import time
+from threading import Lock
+
+import fair_queue
+import settings
+import token_scheduler
+from models import ClientKey
+
+PRIORITY_HEADER = 'X-Priority'
+
+_TOTAL_TOKENS_RE = re.compile(rb'"total_tokens"\s*:\s*(\d+)')
+_TAIL_BYTES = 8192
+_BYTES_PER_TOKEN = 4   # 没有 usage 时的粗略估算
+
+
+def _digest(value: str) -> bytes:
+    return hashlib.sha256((value or '').encode('utf-8')).digest()
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'level', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n: float, now: float) -> float:
+        """取 n 个令牌；成功返回 0，否则返回需要等待的秒数。"""
+        self._refill(now)
+        if self.level >= n:
+            self.level -= n
+            return 0.0
+        return (n - self.level) / self.rate
+
+    def charge(self, n: float, now: float):
+        """事后记账，余额可以为负。"""
+        self._refill(now)
+        self.level -= n
+
+
+class ClientState:
+    __slots__ = ('id', 'name', 'weight', 'priority', 'max_streams', 'limits', 'rps_bucket', 'tpm_bucket',
+                 'streams', 'in_flight', 'usage', 'last_used')
+
+    def __init__(self, client_id: int, name: str):
+        self.id = client_id
+        self.name = name
+        self.weight = 1
+        self.priority = None
+        self.max_streams = None
+        self.limits = None
+        self.rps_bucket = None
+        self.tpm_bucket = None
+        self.streams = 0
+        self.in_flight = 0
+        self.usage = {'requests': 0, 'tokens': 0, 'tokens_estimated': 0, 'cache_hits': 0,
+                      'rejected_rps': 0, 'rejected_tpm': 0, 'rejected_streams': 0, 'rejected_queue': 0}
+        self.last_used = None
+
+    def configure(self, row: ClientKey):
+        self.name = row.name
+        self.weight = max(1, int(row.weight or 1))
+        self.priority = row.priority if row.priority in token_scheduler.PRIORITIES else None
+        self.max_streams = int(row.max_streams) if row.max_streams is not None and row.max_streams >= 0 else None
+        rps = float(row.rps) if row.rps is not None and row.rps > 0 else None
+        burst = int(row.burst) if row.burst is not None and row.burst > 0 else None
+        tpm = int(row.tpm) if row.tpm is not None and row.tpm > 0 else None
+        limits = (rps, burst, tpm)
+        if limits == self.limits:
+            return
+        self.limits = limits
+        self.rps_bucket = TokenBucket(rps, burst or max(1, math.ceil(rps))) if rps else None
+        self.tpm_bucket = TokenBucket(tpm / 60.0, tpm) if tpm else None
+
+
+# SystemConfig.api_key 对应的不限额客户端
+SHARED = ClientState(0, 'default')
+
+_lock = Lock()
+_index: dict[bytes, ClientState] | None = None
+_by_id: dict[int, ClientState] = {}
+
+
+def _load() -> dict[bytes, ClientState]:
+    """需要在 app context 中调用。"""
+    global _index, _by_id
+    with _lock:
+        if _index is not None:
+            return _index
+        index, by_id = {}, {}
+        for row in ClientKey.query.all():
+            state = _by_id.get(row.id) or ClientState(row.id, row.name)
+            state.configure(row)
+            by_id[row.id] = state
+            if row.is_active and row.key:
+                index[_digest(row.key)] = state
+        _by_id = by_id
+        _index = index
+        return index
+
+
+def invalidate():
+    global _index
+    with _lock:
+        _index = None
+
+
+def ensure_loaded():
+    if _index is None:
+        _load()
+
+
+def state_of(client_id: int) -> ClientState | None:
+    return _by_id.get(client_id)
+
+
+def authenticate(config, provided: str | None) -> ClientState | None:
+    if not provided:
+        return None
+    index = _index if _index is not None else _load()
+    client = index.get(_digest(provided))
+    if client is not None:
+        return client
+    if config is not None and config.check_api_key(provided):
+        return SHARED
+    return None
+
+
+def resolve_priority(client: ClientState, requested: str | None) -> str:
+    requested = (requested or '').strip().lower()
+    if client.priority == token_scheduler.PRIORITY_LOW:
+        return token_scheduler.PRIORITY_LOW
+    if requested in token_scheduler.PRIORITIES:
+        return requested
+    if client.priority is not None:
+        return client.priority
+    default = settings.PRIORITY_DEFAULT
+    return default if default in token_scheduler.PRIORITIES else token_scheduler.PRIORITY_HIGH
+
+
+class Ticket:
+    """一次已放行的请求：持有流式计数和转发名额，finish() 时归还并记账。"""
+    __slots__ = ('client', 'priority', 'stream', 'request_bytes', 'slot', '_finished')
+
+    def __init__(self, client: ClientState, priority: str, stream: bool, request_bytes: int):
+        self.client = client
+        self.priority = priority
+        self.stream = stream
+        self.request_bytes = request_bytes
+        self.slot = False
+        self._finished = False
+
+    def wait_slot(self) -> bool:
+        """占用转发名额（拥塞时按权重排队）；超时返回 False。"""
+        if self.slot:
+            return True
+        self.slot = fair_queue.gate.acquire(self.client.id, self.client.weight, settings.FAIR_QUEUE_TIMEOUT,
+                                            low=self.priority == token_scheduler.PRIORITY_LOW)
+        if not self.slot:
+            with _lock:
+                self.client.usage['rejected_queue'] += 1
+        return self.slot
+
+    def finish(self, response_bytes: int = 0, tail: bytes = b'', cached: bool = False):
+        """结束请求并记账；cached 为 True 时响应来自缓存，没有消耗上游，不计入 TPM。"""
+        with _lock:
+            if self._finished:
+                return
+            self._finished = True
+            client = self.client
+            client.in_flight = max(0, client.in_flight - 1)
+            if self.stream:
+                client.streams = max(0, client.streams - 1)
+            if cached:
+                client.usage['cache_hits'] += 1
+            else:
+                self._charge(client, response_bytes, tail)
+        if self.slot:
+            self.slot = False
+            fair_queue.gate.release()
+
+    def _charge(self, client: ClientState, response_bytes: int, tail: bytes):
+        """按 usage 中的 total_tokens（没有时按字节数估算）记入用量和 TPM；调用方持有 _lock。"""
+        found = _TOTAL_TOKENS_RE.findall(tail)
+        if found:
+            tokens = int(found[-1])
+        else:
+            tokens = (self.request_bytes + response_bytes) // _BYTES_PER_TOKEN
+            client.usage['tokens_estimated'] += tokens
+        client.usage['tokens'] += tokens
+        if client.tpm_bucket is not None:
+            client.tpm_bucket.charge(tokens, time.monotonic())
+
+
+def admit(client: ClientState, priority: str, stream: bool, request_bytes: int) -> tuple[Ticket | None, str | None, float]:
+    """检查限额；放行时返回 (ticket, None, 0)，否则返回 (None, 原因, 建议等待秒数)。"""
+    now = time.monotonic()
+    with _lock:
+        client.last_used = time.time()
+        if stream and client.max_streams is not None and client.streams >= client.max_streams:
+            client.usage['rejected_streams'] += 1
+            return None, 'streams', 1.0
+        tpm = client.tpm_bucket
+        if tpm is not None:
+            wait = tpm.take(0, now)
+            if wait > 0:
+                client.usage['rejected_tpm'] += 1
+                return None, 'tpm', wait
+        if client.rps_bucket is not None:
+            wait = client.rps_bucket.take(1, now)
+            if wait > 0:
+                client.usage['rejected_rps'] += 1
+                return None, 'rps', wait
+        client.usage['requests'] += 1
+        client.in_flight += 1
+        if stream:
+            client.streams += 1
+    return Ticket(client, priority, stream, request_bytes), None, 0.0
+
+
+def meter(ticket: Ticket, response):
+    """响应体转发完毕（或客户端断开）时结束 ticket；response 为 Flask Response。"""
+    body = response.response
+    seen = {'size': 0, 'tail': b''}
+    cached = response.headers.get('X-Cache') == 'HIT'
+
+    def counted():
+        try:
+            for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                seen['size'] += len(chunk)
+                seen['tail'] = (seen['tail'] + chunk)[-_TAIL_BYTES:]
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            ticket.finish(seen['size'], seen['tail'], cached)
+
+    response.response = counted()
+    # 响应体从未被迭代时生成器的 finally 不会执行，关闭响应时兜底
+    response.call_on_close(lambda: ticket.finish(seen['size'], seen['tail'], cached))
+    return response
+
+
+def _bucket_level(bucket: TokenBucket | None):
+    if bucket is None:
+        return None
+    with _lock:
+        bucket._refill(time.monotonic())
+        return round(bucket.level, 2)
+
+
+def snapshot(client: ClientState) -> dict:
+    rps, burst, tpm = client.limits or (None, None, None)
+    with _lock:
+        usage = dict(client.usage)
+        in_flight, streams = client.in_flight, client.streams
+    return {
+        'in_flight': in_flight,
+        'streams': streams,
+        'rps_available': _bucket_level(client.rps_bucket),
+        'tpm_available': _bucket_level(client.tpm_bucket),
+        'last_used': client.last_used,
+        **usage,
+    }
+
+
+def stats() -> dict:
+    clients = [SHARED] + sorted(_by_id.values(), key=lambda c: c.id)
+    return {
+        'fair_queue': fair_queue.gate.stats(),
+        'clients': [
+            {'id': c.id, 'name': c.name, 'weight': c.weight, 'priority': c.priority, **snapshot(c)}
+            for c in clients
+        ],
+    }
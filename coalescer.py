@@ -0,0 +1,288 @@
+"""相同对话请求的合并（single-flight，COALESCE_ENABLED 开启）。
+
+同一调用方 Key 的同一请求体（规范化 JSON 的 SHA-256）已有请求在处理时，后到的请求不再占用 token，
+而是挂到第一个请求（leader）上：leader 的响应体边转发边写入共享缓冲区，follower 先
+从缓冲区补齐已到达的数据，再跟随后续数据块。流式 follower 得到同样的 SSE 字节，
+非流式 follower 得到同样的响应体。
+
+缓冲区上限为 COALESCE_MAX_BUFFER 字节：超过后不再接受新的 follower，并丢弃所有
+follower 都已读过的数据；落后超过上限的 follower 会被断开。leader 在返回响应前失败、
+或 follower 还没收到任何数据时 leader 就中断了，follower 各自正常请求上游；已经开始转发后
+才中断（leader 客户端断开）或被断开的 follower，流式响应以一个 error 事件结束，非流式响应
+直接断开连接，客户端不会把不完整的响应当作正常结束。请求头 X-Coalesce: 0 可跳过合并。
+
+超过 COALESCE_WAIT_TIMEOUT 秒没有任何进展（没有响应头也没有新数据）的 flight 视为卡住，
+按中断处理并从表中移除。
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from threading import Lock
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+OPT_OUT_HEADER = 'X-Coalesce'
+_PASS_HEADERS = ('Content-Type', 'Content-Encoding', 'Content-Length', 'Vary', 'Cache-Control', 'X-Cache')
+_SWEEP_INTERVAL = 1.0
+
+
+class FlightBroken(Exception):
+    """follower 拿不到完整的响应体。"""
+
+
+class Flight:
+    def __init__(self, key: str):
+        self.key = key
+        self.cond = threading.Condition()
+        self.chunks: list[bytes] = []
+        self.base = 0           # chunks[0] 的绝对序号
+        self.buffered = 0       # chunks 中的字节数
+        self.joinable = True
+        self.done = False
+        self.aborted = False
+        self.status = None
+        self.headers = None
+        self.positions: dict[int, int] = {}  # follower -> 下一个要读的绝对序号
+        self.active_at = time.monotonic()    # 最近一次发布响应头或追加数据的时间
+        self._next_id = 0
+
+    # --- leader ---
+
+    def publish(self, status: int, headers: dict):
+        with self.cond:
+            self.status = status
+            self.headers = headers
+            self.active_at = time.monotonic()
+            self.cond.notify_all()
+
+    def append(self, chunk: bytes):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.buffered += len(chunk)
+            self.active_at = time.monotonic()
+            if self.buffered > settings.COALESCE_MAX_BUFFER:
+                self._trim()
+            self.cond.notify_all()
+
+    def _trim(self):
+        # 超过上限后新的 follower 无法再从头补齐
+        self.joinable = False
+        _close(self)
+        floor = min(self.positions.values(), default=self.base + len(self.chunks))
+        self._drop_until(floor)
+        if self.buffered > settings.COALESCE_MAX_BUFFER and self.positions:
+            # 仍然超限：断开最落后的 follower
+            slowest = min(self.positions, key=self.positions.get)
+            del self.positions[slowest]
+            _stats_add('followers_dropped')
+            floor = min(self.positions.values(), default=self.base + len(self.chunks))
+            self._drop_until(floor)
+
+    def _drop_until(self, floor: int):
+        drop = floor - self.base
+        if drop <= 0:
+            return
+        self.buffered -= sum(len(c) for c in self.chunks[:drop])
+        del self.chunks[:drop]
+        self.base = floor
+
+    def finish(self, aborted: bool = False):
+        """结束 flight；只有第一次调用生效。"""
+        with self.cond:
+            if self.done:
+                return
+            self.done = True
+            self.aborted = aborted
+            self.cond.notify_all()
+        _close(self)
+
+    # --- follower ---
+
+    def attach(self) -> int | None:
+        with self.cond:
+            if not self.joinable or self.done:
+                return None
+            follower = self._next_id
+            self._next_id += 1
+            self.positions[follower] = self.base
+            return follower
+
+    def _readable(self, follower: int) -> bool:
+        position = self.positions.get(follower)
+        return position is not None and position < self.base + len(self.chunks)
+
+    def wait_ready(self, follower: int, timeout: float) -> bool:
+        """等待响应头和第一段数据（或正常结束）；leader 在此之前失败时返回 False。"""
+        with self.cond:
+            self.cond.wait_for(
+                lambda: self.done or (self.status is not None and self._readable(follower)), timeout)
+            if self.status is None or follower not in self.positions:
+                return False
+            return self._readable(follower) or (self.done and not self.aborted)
+
+    def read(self, follower: int):
+        """按顺序产出数据；被断开或 leader 中途失败时抛出 FlightBroken。"""
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(
+                        lambda: follower not in self.positions or self.done
+                        or self.positions[follower] < self.base + len(self.chunks))
+                    position = self.positions.get(follower)
+                    if position is None:
+                        raise FlightBroken('follower fell behind the coalescing buffer')
+                    pending = self.chunks[position - self.base:]
+                    if not pending and self.done:
+                        if self.aborted:
+                            raise FlightBroken('leader response was aborted')
+                        return
+                    self.positions[follower] = position + len(pending)
+                for chunk in pending:
+                    yield chunk
+        finally:
+            with self.cond:
+                self.positions.pop(follower, None)
+
+
+_lock = Lock()
+_flights: dict[str, Flight] = {}
+_last_sweep = 0.0
+_stats = {'flights': 0, 'stale': 0, 'followers': 0, 'followers_dropped': 0, 'followers_failed': 0, 'refused': 0, 'aborted': 0}
+
+
+def _stats_add(name: str, n: int = 1):
+    with _lock:
+        _stats[name] += n
+
+
+def _close(flight: Flight):
+    with _lock:
+        if _flights.get(flight.key) is flight:
+            del _flights[flight.key]
+
+
+def flight_key(payload: dict, headers, client_id: int) -> str | None:
+    """client_id 为调用方 Key 的标识，不同 Key 的请求互不合并。"""
+    if not settings.COALESCE_ENABLED:
+        return None
+    if (headers.get(OPT_OUT_HEADER) or '').strip().lower() in ('0', 'false', 'off', 'no'):
+        return None
+    try:
+        raw = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    except (TypeError, ValueError):
+        return None
+    # 非流式响应可能原样转发压缩数据，只合并 Accept-Encoding 相同的请求
+    raw += '\n' + (headers.get('Accept-Encoding') or '').replace(' ', '').lower()
+    raw = f"{client_id}\n{raw}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def _sweep(now: float) -> list[Flight]:
+    """取出卡住的 flight（调用方持有 _lock，在锁外结束它们）。"""
+    global _last_sweep
+    if now - _last_sweep < _SWEEP_INTERVAL:
+        return []
+    _last_sweep = now
+    stale = [f for f in _flights.values() if now - f.active_at > settings.COALESCE_WAIT_TIMEOUT]
+    for flight in stale:
+        del _flights[flight.key]
+    _stats['stale'] += len(stale)
+    return stale
+
+
+def join(key: str) -> tuple[Flight, bool]:
+    """返回 (flight, 是否为 leader)。"""
+    with _lock:
+        stale = _sweep(time.monotonic())
+    for flight in stale:
+        logger.warning("Coalesced flight made no progress, dropping it")
+        flight.finish(aborted=True)
+    with _lock:
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = Flight(key)
+            _stats['flights'] += 1
+            return flight, True
+        return flight, False
+
+
+def lead(flight: Flight, response):
+    """把 leader 的响应体接入共享缓冲区；response 为 Flask Response。"""
+    headers = {k: response.headers[k] for k in _PASS_HEADERS if k in response.headers}
+    flight.publish(response.status_code, headers)
+    body = response.response
+
+    state = {'completed': False}
+
+    def end():
+        if not flight.done:
+            flight.finish(aborted=not state['completed'])
+            if not state['completed']:
+                _stats_add('aborted')
+
+    def tee():
+        try:
+            for chunk in body:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                flight.append(chunk)
+                yield chunk
+            state['completed'] = True
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            end()
+
+    response.response = tee()
+    # 客户端在第一个数据块之前断开时生成器的 finally 不会执行，关闭响应时兜底
+    response.call_on_close(end)
+    return response
+
+
+def abort(flight: Flight):
+    """leader 在得到响应前失败：让 follower 自行请求。"""
+    flight.finish(aborted=True)
+    _stats_add('aborted')
+
+
+def follow(flight: Flight):
+    """返回 (status, headers, body 迭代器)；无法跟随时返回 None，调用方自行请求上游。"""
+    follower = flight.attach()
+    if follower is None:
+        _stats_add('refused')
+        return None
+    if not flight.wait_ready(follower, settings.COALESCE_WAIT_TIMEOUT):
+        with flight.cond:
+            flight.positions.pop(follower, None)
+        _stats_add('refused')
+        return None
+    _stats_add('followers')
+    headers = dict(flight.headers)
+    sse_stream = 'text/event-stream' in headers.get('Content-Type', '').lower()
+    return flight.status, headers, _relay(flight, follower, sse_stream)
+
+
+def _relay(flight: Flight, follower: int, sse_stream: bool):
+    try:
+        yield from flight.read(follower)
+    except FlightBroken as e:
+        _stats_add('followers_failed')
+        logger.warning(f"Coalesced follower cut off: {e}")
+        if not sse_stream:
+            # 非流式响应已经发出 200，只能断开连接让客户端知道响应不完整
+            raise
+        # 前面的空行结束可能只转发了一半的事件
+        error = {'error': {'message': f"Upstream response interrupted: {e}", 'type': 'upstream_error'}}
+        yield b'\n\ndata: ' + json.dumps(error).encode('utf-8') + b'\n\n'
+
+
+def stats() -> dict:
+    with _lock:
+        out = dict(_stats)
+        out['in_flight'] = len(_flights)
+    out['enabled'] = settings.COALESCE_ENABLED
+    return out
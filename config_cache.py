@@ -0,0 +1,61 @@
+"""SystemConfig 的内存快照。
+
+热路径（API Key 校验、重试次数、流式转换开关等）只读快照，不访问数据库；
+修改 SystemConfig 的接口在提交后调用 invalidate()，下次读取时重新加载。
+"""
+import hashlib
+import hmac
+from threading import Lock
+
+from models import SystemConfig
+
+_FIELDS = (
+    'id', 'admin_username', 'error_ban_threshold', 'error_retry_count', 'debug_enabled',
+    'at_auto_refresh_enabled', 'token_refresh_interval', 'stream_conversion_enabled',
+    'proxy_enabled', 'proxy_url', 'cache_enabled', 'cache_timeout', 'cache_base_url',
+    'image_timeout', 'video_timeout',
+)
+
+
+def _digest(value: str) -> bytes:
+    return hashlib.sha256((value or '').encode('utf-8')).digest()
+
+
+class ConfigSnapshot:
+    __slots__ = _FIELDS + ('api_key_digest',)
+
+    def __init__(self, config: SystemConfig):
+        for name in _FIELDS:
+            setattr(self, name, getattr(config, name, None))
+        # 只保存摘要：比较定长摘要，用 compare_digest 做常数时间比较
+        self.api_key_digest = _digest(config.api_key)
+
+    def check_api_key(self, provided: str | None) -> bool:
+        if not provided:
+            return False
+        return hmac.compare_digest(_digest(provided), self.api_key_digest)
+
+
+_lock = Lock()
+_snapshot: ConfigSnapshot | None = None
+
+
+def get() -> ConfigSnapshot | None:
+    """需要在 app context 中调用（首次或失效后会查询一次数据库）。"""
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is not None:
+        return snapshot
+    with _lock:
+        if _snapshot is None:
+            config = SystemConfig.query.first()
+            if config is None:
+                return None
+            _snapshot = ConfigSnapshot(config)
+        return _snapshot
+
+
+def invalidate():
+    global _snapshot
+    with _lock:
+        _snapshot = None
@@ -0,0 +1,107 @@
+"""转发并发上限与按客户端的加权公平排队（WFQ）。
+
+同时转发到上游的对话请求数达到 PROXY_MAX_CONCURRENCY 后，新请求按客户端排队：
+每个请求的虚拟完成时间为 max(系统虚拟时间, 该客户端上一个请求的完成时间) + 1 / weight，
+有空闲名额时放行虚拟完成时间最小的请求。权重为 2 的客户端在拥塞时得到两倍的名额，
+单个客户端的大量请求不会饿死其他客户端。
+
+低优先级请求单独排队，只在高优先级队列为空时放行，并且只使用 PRIORITY_RESERVED_SHARE
+预留之外的名额。
+"""
+import heapq
+import itertools
+import threading
+from threading import Lock
+
+import settings
+import token_scheduler
+
+
+class _Waiter:
+    __slots__ = ('event', 'granted', 'cancelled')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.granted = False
+        self.cancelled = False
+
+
+class FairQueue:
+    def __init__(self):
+        self._lock = Lock()
+        self._in_use = 0
+        # 以下按是否低优先级分开：虚拟时间、排队堆、排队数
+        self._vtime = {False: 0.0, True: 0.0}
+        self._finish: dict = {}   # (客户端, 是否低优先级) -> 最近一次排队请求的虚拟完成时间
+        self._heaps = {False: [], True: []}
+        self._waiting = {False: 0, True: 0}
+        self._seq = itertools.count()
+        self._stats = {'admitted': 0, 'queued': 0, 'timeouts': 0}
+
+    @staticmethod
+    def _limit(low: bool) -> int | None:
+        capacity = settings.PROXY_MAX_CONCURRENCY
+        if capacity <= 0:
+            return None
+        return token_scheduler.low_priority_cap(capacity) if low else capacity
+
+    def acquire(self, flow, weight: float, timeout: float, low: bool = False) -> bool:
+        """占用一个转发名额；排队超过 timeout 秒返回 False。"""
+        with self._lock:
+            limit = self._limit(low)
+            ahead = self._waiting[False] + (self._waiting[True] if low else 0)
+            if limit is None or (self._in_use < limit and not ahead):
+                self._in_use += 1
+                self._stats['admitted'] += 1
+                return True
+            key = (flow, low)
+            tag = max(self._vtime[low], self._finish.get(key, 0.0)) + 1.0 / max(weight, 0.001)
+            self._finish[key] = tag
+            waiter = _Waiter()
+            heapq.heappush(self._heaps[low], (tag, next(self._seq), waiter))
+            self._waiting[low] += 1
+            self._stats['queued'] += 1
+        waiter.event.wait(timeout)
+        with self._lock:
+            if waiter.granted:
+                return True
+            # 懒删除：出队时跳过
+            waiter.cancelled = True
+            self._waiting[low] -= 1
+            self._stats['timeouts'] += 1
+            return False
+
+    def release(self):
+        with self._lock:
+            self._in_use = max(0, self._in_use - 1)
+            self._dispatch()
+
+    def _dispatch(self):
+        for low in (False, True):
+            heap = self._heaps[low]
+            limit = self._limit(low)
+            while heap and (limit is None or self._in_use < limit):
+                tag, _, waiter = heapq.heappop(heap)
+                if waiter.cancelled:
+                    continue
+                self._vtime[low] = tag
+                self._in_use += 1
+                self._waiting[low] -= 1
+                self._stats['admitted'] += 1
+                waiter.granted = True
+                waiter.event.set()
+            if self._waiting[False]:
+                # 高优先级还有排队的请求时不放行低优先级
+                return
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._stats)
+            out['in_use'] = self._in_use
+            out['waiting'] = self._waiting[False] + self._waiting[True]
+            out['waiting_low'] = self._waiting[True]
+        out['capacity'] = settings.PROXY_MAX_CONCURRENCY
+        return out
+
+
+gate = FairQueue()
@@ -0,0 +1,23 @@
+# Gunicorn 配置
+# 默认使用 gevent 协程 worker：/v1/chat/completions 的长连接 SSE 流只占用一个协程，
+# 不再像 gthread 那样每个流独占一个线程（--threads 4 时第 5 个客户端就要排队）。
+# 设置 GUNICORN_WORKER_CLASS=gthread 可回退到原来的线程模式。
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# Token 轮询状态、调度器都在进程内存中，保持单 worker
+workers = int(os.environ.get('GUNICORN_WORKERS', '1'))
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+
+# gevent: 单进程可同时持有的连接数（即并发上游流数量）
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '2000'))
+# gthread: 线程数
+threads = int(os.environ.get('GUNICORN_THREADS', '4'))
+
+# 异步 worker 的 timeout 只检测心跳，不会打断长时间的流式响应
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '120'))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', '5'))
+
+accesslog = '-'
+errorlog = '-'
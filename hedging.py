@@ -0,0 +1,122 @@
+"""对冲请求：主请求在近期 TTFB 的高分位（如 p95）内还没出首字节时，用另一个 token 再发一次，
+先出首字节的一方胜出，另一方被取消：立即归还并发名额并断开上游连接；取消时上游已经给出的
+状态码交给 settle 回调，仍然计入限流、熔断等统计。对冲预算限制额外的上游负载（如不超过请求数的 5%）。
+"""
+import logging
+import queue
+import threading
+from collections import deque
+from threading import Lock
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = Lock()
+# 上游流式 / 非流式的首字节耗时差别很大，分开统计
+_samples = {True: deque(maxlen=500), False: deque(maxlen=500)}
+_budget = float(settings.HEDGE_BUDGET_BURST)
+_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'budget_exhausted': 0}
+
+
+def record_ttfb(stream: bool, seconds: float):
+    with _lock:
+        _samples[stream].append(seconds)
+
+
+def percentile(stream: bool, pct: float) -> float | None:
+    with _lock:
+        data = sorted(_samples[stream])
+    if len(data) < settings.HEDGE_MIN_SAMPLES:
+        return None
+    index = min(len(data) - 1, max(0, int(round(pct / 100.0 * len(data))) - 1))
+    return data[index]
+
+
+def hedge_delay(stream: bool) -> float | None:
+    """返回触发对冲前的等待秒数；样本不足时返回 None（不对冲）。"""
+    value = percentile(stream, settings.HEDGE_PERCENTILE)
+    if value is None:
+        return None
+    return max(settings.HEDGE_MIN_DELAY, value)
+
+
+def note_request():
+    """每个可对冲的请求为预算充值 HEDGE_BUDGET_RATIO。"""
+    global _budget
+    with _lock:
+        _stats['requests'] += 1
+        _budget = min(float(settings.HEDGE_BUDGET_BURST), _budget + settings.HEDGE_BUDGET_RATIO)
+
+
+def _take_budget() -> bool:
+    global _budget
+    with _lock:
+        if _budget < 1.0:
+            _stats['budget_exhausted'] += 1
+            return False
+        _budget -= 1.0
+        _stats['hedged'] += 1
+        return True
+
+
+def _start(attempt, send, results, settle):
+    def run():
+        attempt.open(send)
+        if attempt.abandoned:
+            settle(attempt)
+        else:
+            results.put(attempt)
+    threading.Thread(target=run, name='hedge-attempt', daemon=True).start()
+
+
+def race(primary, send_primary, delay: float, make_backup, settle):
+    """运行主请求，必要时发起对冲。
+
+    make_backup() 返回 (attempt, send) 或 None（没有可用 token）。
+    返回 (winner, finished)：winner 为最终采用的尝试；finished 为其余已结束、需要按
+    失败处理的尝试。被取消的尝试已经关闭，不在返回值中，其结果交给 settle(attempt)
+    （可能在后台线程中调用）。
+    """
+    results = queue.Queue()
+    _start(primary, send_primary, results, settle)
+    try:
+        return results.get(timeout=delay), []
+    except queue.Empty:
+        pass
+
+    backup = make_backup() if _take_budget() else None
+    if backup is None:
+        return results.get(), []
+    backup_attempt, send_backup = backup
+    logger.info(f"Hedging: token {primary.token.id} has no first byte after {delay:.2f}s, "
+                f"also trying token {backup_attempt.token.id}")
+    _start(backup_attempt, send_backup, results, settle)
+
+    first = results.get()
+    other = backup_attempt if first is primary else primary
+    if first.ok:
+        if other.cancel():
+            settle(other)
+        if first is backup_attempt:
+            with _lock:
+                _stats['hedge_wins'] += 1
+        return first, []
+    # 先结束的一方失败了，等另一方的结果
+    second = results.get()
+    if second.ok and second is backup_attempt:
+        with _lock:
+            _stats['hedge_wins'] += 1
+    return second, [first]
+
+
+def stats() -> dict:
+    with _lock:
+        out = dict(_stats)
+        out['budget'] = round(_budget, 2)
+    out['enabled'] = settings.HEDGE_ENABLED
+    for stream in (True, False):
+        key = 'stream' if stream else 'nonstream'
+        out[f'{key}_ttfb_p50'] = percentile(stream, 50)
+        out[f'{key}_ttfb_p{settings.HEDGE_PERCENTILE:g}'] = percentile(stream, settings.HEDGE_PERCENTILE)
+    return out
@@ -0,0 +1,163 @@
+"""RequestLog 异步批量写入：请求路径只入队，后台线程定期用一条 executemany 事务落库。"""
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import insert
+
+import settings
+from extensions import db
+from models import RequestLog
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('drop', 'sample', 'block')
+
+
+class RequestLogWriter:
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=1.0,
+                 overflow_policy='drop', sample_rate=0.1, block_timeout=0.5):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            logger.warning(f"Unknown log overflow policy {overflow_policy!r}, falling back to 'drop'")
+            overflow_policy = 'drop'
+        self.max_queue = max(1, max_queue)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = max(0.05, flush_interval)
+        self.overflow_policy = overflow_policy
+        # sample: 队列超过 80% 后只按 sample_rate 比例接收
+        self.sample_rate = min(1.0, max(0.0, sample_rate))
+        self.block_timeout = max(0.0, block_timeout)
+
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._app = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._enqueued = 0
+        self._written = 0
+        self._dropped = 0
+        self._sampled_out = 0
+        self._failed = 0
+        self._flushes = 0
+        self._flush_total = 0.0
+        self._flush_last = 0.0
+        self._flush_max = 0.0
+
+    def init_app(self, app):
+        self._app = app
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='request-log-writer', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def submit(self, **fields):
+        fields.setdefault('created_at', datetime.now())
+        if self.overflow_policy == 'sample' and self._queue.qsize() >= self.max_queue * 0.8:
+            if random.random() >= self.sample_rate:
+                self._count('_sampled_out')
+                return False
+        try:
+            if self.overflow_policy == 'block':
+                self._queue.put(fields, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(fields)
+        except queue.Full:
+            self._count('_dropped')
+            return False
+        self._count('_enqueued')
+        return True
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def _take_batch(self) -> list[dict]:
+        try:
+            rows = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        # 攒满一个刷新周期（或 batch_size）再写，减少 fsync 次数
+        deadline = time.monotonic() + self.flush_interval
+        while len(rows) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or self._stop.is_set():
+                break
+            try:
+                rows.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rows
+
+    def _drain(self) -> list[dict]:
+        rows = []
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return rows
+
+    def _flush(self, rows: list[dict]):
+        if not rows:
+            return
+        start = time.perf_counter()
+        try:
+            with self._app.app_context():
+                db.session.execute(insert(RequestLog), rows)
+                db.session.commit()
+        except Exception as e:
+            logger.error(f"Failed to write {len(rows)} request log(s): {e}")
+            self._count('_failed', len(rows))
+            return
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self._written += len(rows)
+            self._flushes += 1
+            self._flush_last = elapsed
+            self._flush_total += elapsed
+            self._flush_max = max(self._flush_max, elapsed)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._flush(self._take_batch())
+        rows = self._drain()
+        while rows:
+            self._flush(rows)
+            rows = self._drain()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            flushes = self._flushes
+            return {
+                'overflow_policy': self.overflow_policy,
+                'queue_depth': self._queue.qsize(),
+                'max_queue': self.max_queue,
+                'enqueued': self._enqueued,
+                'written': self._written,
+                'dropped': self._dropped,
+                'sampled_out': self._sampled_out,
+                'failed': self._failed,
+                'flushes': flushes,
+                'last_flush_ms': round(self._flush_last * 1000, 2),
+                'avg_flush_ms': round(self._flush_total / flushes * 1000, 2) if flushes else 0.0,
+                'max_flush_ms': round(self._flush_max * 1000, 2),
+            }
+
+
+writer = RequestLogWriter(
+    max_queue=settings.LOG_QUEUE_SIZE,
+    batch_size=settings.LOG_BATCH_SIZE,
+    flush_interval=settings.LOG_FLUSH_INTERVAL,
+    overflow_policy=settings.LOG_OVERFLOW_POLICY,
+    sample_rate=settings.LOG_SAMPLE_RATE,
+    block_timeout=settings.LOG_BLOCK_TIMEOUT,
+)
@@ -0,0 +1,206 @@
+"""/v1/models 缓存与按 token 的模型发现。
+
+- 后台任务定期用每个可用 token 请求上游 /api/v1/models，记录到 TokenRecord.models，
+  并把所有 token 的模型合并成一份缓存的响应体（带 ETag）；
+- /v1/models 直接返回缓存；超过 MODELS_CACHE_TTL 后仍返回旧数据，同时在后台刷新
+  （stale-while-revalidate）；
+- 对话请求只发给支持所请求模型的 token；目录里没有的模型不做过滤；
+- 发现请求按低优先级占用 token 的并发名额，跳过熔断未关闭的 token；用小线程池并发请求，
+  整轮刷新有时限；一个模型列表都没拿到的刷新之后，按请求触发的后台刷新指数退避
+  （最长 MODELS_CACHE_TTL）。
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Lock
+
+import circuit_breaker
+import rate_limits
+import settings
+import upstream
+from token_pool import TokenRecord, pool
+
+logger = logging.getLogger(__name__)
+
+_RETRY_BASE = 5  # 刷新失败后第一次重试前等待的秒数，之后逐次翻倍
+
+
+class Catalog:
+    __slots__ = ('body', 'etag', 'fetched_at', 'ids')
+
+    def __init__(self, entries: list[dict]):
+        entries = sorted(entries, key=lambda e: str(e.get('id')))
+        self.body = json.dumps({'object': 'list', 'data': entries}, ensure_ascii=False).encode('utf-8')
+        self.etag = hashlib.sha256(self.body).hexdigest()[:32]
+        self.fetched_at = time.monotonic()
+        self.ids = frozenset(e.get('id') for e in entries)
+
+    @property
+    def stale(self) -> bool:
+        return time.monotonic() - self.fetched_at > settings.MODELS_CACHE_TTL
+
+
+_lock = Lock()
+_refresh_lock = Lock()
+_catalog: Catalog | None = None
+_entries: dict[str, dict] = {}
+_stats = {'refreshes': 0, 'refresh_errors': 0, 'last_refresh_seconds': None}
+_failures = 0                 # 连续没有拿到任何模型列表的刷新次数
+_attempted_at: float | None = None
+
+
+def get() -> Catalog | None:
+    return _catalog
+
+
+def parse(body: bytes) -> list[dict] | None:
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    items = data.get('data') if isinstance(data, dict) else None
+    if not isinstance(items, list):
+        return None
+    return [item for item in items if isinstance(item, dict) and item.get('id')]
+
+
+def ingest(record: TokenRecord, body: bytes) -> Catalog | None:
+    """记录某个 token 的模型列表并合并进目录；响应无法解析时返回 None。"""
+    global _catalog
+    entries = parse(body)
+    if entries is None:
+        return None
+    record.models = frozenset(e['id'] for e in entries)
+    with _lock:
+        for entry in entries:
+            _entries.setdefault(entry['id'], entry)
+        _catalog = Catalog(list(_entries.values()))
+        return _catalog
+
+
+def _fetch(record: TokenRecord) -> list[dict] | None:
+    headers = {"Authorization": f"Bearer {record.zai_token}"}
+    if record.zai_darkknight:
+        headers["x-zai-darkknight"] = record.zai_darkknight
+    resp = upstream.client.get('/api/v1/models', headers=headers,
+                               timeout=(settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_TTFB_TIMEOUT))
+    try:
+        rate_limits.observe(record, resp.status_code, resp.headers)
+        if resp.status_code >= 400:
+            logger.debug(f"Model discovery for token {record.id} failed: HTTP {resp.status_code}")
+            return None
+        return parse(resp.content)
+    finally:
+        resp.close()
+
+
+def _discover(record: TokenRecord):
+    """在刷新线程池中运行：返回 (模型列表或 None, 是否真的发出了请求)。"""
+    import token_scheduler  # token_scheduler 依赖本模块，在这里导入避免循环导入
+    # 熔断未关闭时不发发现请求，也不占用半开状态的探测机会
+    if record.cb_state != circuit_breaker.CLOSED:
+        return None, False
+    lease = token_scheduler.acquire(record, token_scheduler.KIND_CHAT, token_scheduler.PRIORITY_LOW)
+    if lease is None:
+        return None, False
+    try:
+        return _fetch(record), True
+    except Exception as e:
+        logger.debug(f"Model discovery for token {record.id} failed: {e}")
+        return None, True
+    finally:
+        lease.release()
+
+
+def refresh():
+    """用所有可用 token 重新发现模型；已有刷新在进行时直接返回。
+
+    最多 MODELS_REFRESH_CONCURRENCY 个 token 并发请求，超过 MODELS_REFRESH_DEADLINE 秒后
+    不再等待还没返回的 token（沿用它们上一次的结果）。
+    """
+    global _catalog, _failures, _attempted_at
+    if not _refresh_lock.acquire(blocking=False):
+        return
+    started = time.monotonic()
+    try:
+        records = [r for r in pool.records() if r.usable and not rate_limits.is_cooling(r)]
+        executor = ThreadPoolExecutor(max_workers=max(1, settings.MODELS_REFRESH_CONCURRENCY),
+                                      thread_name_prefix='models-discover')
+        futures = {executor.submit(_discover, record): record for record in records}
+        done, not_done = wait(futures, timeout=settings.MODELS_REFRESH_DEADLINE)
+        # 排队中的直接取消；正在请求的在后台自行结束并归还名额
+        executor.shutdown(wait=False, cancel_futures=True)
+        if not_done:
+            logger.warning(f"Model discovery deadline reached, {len(not_done)} token(s) not refreshed")
+
+        merged: dict[str, dict] = {}
+        errors = len(not_done)
+        for future, record in futures.items():
+            entries = None
+            if future in done:
+                entries, attempted = future.result()
+                if entries is None and attempted:
+                    errors += 1
+            if entries is None:
+                # 保留该 token 上一次的结果
+                for model_id in record.models or ():
+                    if model_id in _entries:
+                        merged.setdefault(model_id, _entries[model_id])
+                continue
+            record.models = frozenset(e['id'] for e in entries)
+            for entry in entries:
+                merged.setdefault(entry['id'], entry)
+        with _lock:
+            if merged:
+                _entries.clear()
+                _entries.update(merged)
+                _catalog = Catalog(list(merged.values()))
+                _failures = 0
+            else:
+                _failures += 1
+            _attempted_at = time.monotonic()
+            _stats['refreshes'] += 1
+            _stats['refresh_errors'] += errors
+            _stats['last_refresh_seconds'] = round(time.monotonic() - started, 2)
+    finally:
+        _refresh_lock.release()
+
+
+def retry_in() -> float:
+    """距离下一次允许按请求触发刷新的秒数；上次刷新成功时为 0。"""
+    if not _failures or _attempted_at is None:
+        return 0.0
+    delay = min(settings.MODELS_CACHE_TTL, _RETRY_BASE * 2 ** (_failures - 1))
+    return max(0.0, _attempted_at + delay - time.monotonic())
+
+
+def refresh_async():
+    if _refresh_lock.locked() or retry_in() > 0:
+        return
+    threading.Thread(target=refresh, name='models-refresh', daemon=True).start()
+
+
+def known(model: str | None) -> bool:
+    catalog = _catalog
+    return bool(model) and catalog is not None and model in catalog.ids
+
+
+def supports(record: TokenRecord, model: str) -> bool:
+    """未发现过模型列表的 token 视为支持。"""
+    return record.models is None or model in record.models
+
+
+def stats() -> dict:
+    catalog = _catalog
+    with _lock:
+        out = dict(_stats)
+    out['models'] = len(catalog.ids) if catalog else 0
+    out['age_seconds'] = round(time.monotonic() - catalog.fetched_at, 1) if catalog else None
+    out['etag'] = catalog.etag if catalog else None
+    out['tokens_discovered'] = sum(1 for r in pool.records() if r.models is not None)
+    out['consecutive_failures'] = _failures
+    out['retry_in'] = round(retry_in(), 1)
+    return out
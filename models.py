@@ -43,6 +43,7 @@ class Token(db.Model):
     video_enabled = db.Column(db.Boolean, default=True)
     image_concurrency = db.Column(db.Integer, default=-1)
     video_concurrency = db.Column(db.Integer, default=-1)
+    weight = db.Column(db.Integer, default=1) # 加权选号权重，0 表示不参与加权选号
     
     # Zai Account Info
     credits = db.Column(db.String(64), default='0')
@@ -61,10 +62,30 @@ class Token(db.Model):
     error_count = db.Column(db.Integer, default=0)
     image_count = db.Column(db.Integer, default=0)
     video_count = db.Column(db.Integer, default=0)
+    last_success_at = db.Column(db.DateTime, nullable=True)
+    last_error_at = db.Column(db.DateTime, nullable=True)
     
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
+class ClientKey(db.Model):
+    """调用方 API Key；限额为 -1 表示不限制。"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    key = db.Column(db.String(128), unique=True, nullable=False)
+    is_active = db.Column(db.Boolean, default=True)
+    remark = db.Column(db.String(256), nullable=True)
+
+    # Limits
+    rps = db.Column(db.Float, default=-1)           # 每秒请求数
+    burst = db.Column(db.Integer, default=-1)       # 请求突发量，-1 表示取 rps 向上取整
+    max_streams = db.Column(db.Integer, default=-1) # 同时进行的流式请求数
+    tpm = db.Column(db.Integer, default=-1)         # 每分钟 token 数
+    weight = db.Column(db.Integer, default=1)       # 公平排队权重
+    priority = db.Column(db.String(16), nullable=True)  # high / low，为空时由请求头 X-Priority 或默认值决定
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
 class RequestLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     operation = db.Column(db.String(64)) # e.g. "chat/completions", "refresh"
@@ -0,0 +1,221 @@
+"""一次上游请求尝试：发送请求并读到第一个数据块（或拿到错误响应）为止。
+
+读到首个数据块之前客户端还没有收到任何字节，失败时可以放心换下一个 token。
+Attempt 同时持有上游响应和 token 的并发名额，close() 统一归还。
+
+超时分三段：连接（connect）、首字节（ttfb）、数据块间隔（idle）。前两种在首字节之前
+发生，由调用方换 token 重试；idle 发生时响应已经开始转发，只能结束本次响应。
+各类超时次数按 token 累计在 TokenRecord.timeouts 中。
+
+非流式响应逐块转发：客户端接受上游的 Content-Encoding 时原样转发压缩数据，
+否则由 urllib3 逐块解压。
+
+流式响应统计 SSE 事件数和结束时间；成功拿到响应的尝试在 close() 时交给 on_complete
+注册的回调（token_latency 据此更新首字节耗时和吞吐量）。
+"""
+import logging
+import time
+from threading import Lock
+
+import requests
+from urllib3.exceptions import HTTPError as Urllib3Error, ReadTimeoutError
+
+import adaptive_limit
+import upstream
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024
+RELAY_CHUNK_SIZE = 64 * 1024
+
+_count_lock = Lock()
+_complete_hooks = []
+
+
+def on_complete(hook):
+    """注册尝试结束时的回调 hook(attempt)，只对成功拿到响应的尝试调用。"""
+    _complete_hooks.append(hook)
+
+
+def timeout_kind(exc: Exception) -> str | None:
+    """把 requests 异常归类为 'connect' / 'read'；不是超时返回 None。"""
+    if isinstance(exc, requests.exceptions.ConnectTimeout):
+        return 'connect'
+    if isinstance(exc, (requests.exceptions.ReadTimeout, ReadTimeoutError)):
+        return 'read'
+    # iter_content 中的读超时会被包装成 ConnectionError
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args and isinstance(exc.args[0], ReadTimeoutError):
+        return 'read'
+    return None
+
+
+def accepted_encodings(header: str | None) -> frozenset:
+    """解析客户端的 Accept-Encoding（忽略 q=0 的编码）。"""
+    accepted = set()
+    for item in (header or '').split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name or name in ('*', 'identity'):
+            continue
+        q = params.strip()
+        if q.startswith('q=') and q[2:].strip() in ('0', '0.0', '0.00', '0.000'):
+            continue
+        accepted.add(name)
+    return frozenset(accepted)
+
+
+def count_timeout(record, kind: str):
+    with _count_lock:
+        record.timeouts[kind] = record.timeouts.get(kind, 0) + 1
+    adaptive_limit.on_overload(record)
+
+
+def _set_read_timeout(resp, seconds: float):
+    """首字节之后把同一连接的读超时改为数据块间隔期限。"""
+    conn = getattr(resp.raw, 'connection', None)
+    sock = getattr(conn, 'sock', None)
+    if sock is not None:
+        sock.settimeout(seconds)
+
+
+class Attempt:
+    def __init__(self, token, lease, idle_timeout: float | None = None,
+                 chunk_size: int = CHUNK_SIZE, passthrough: frozenset = frozenset()):
+        self.token = token
+        self.lease = lease
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self.passthrough = passthrough  # 可以原样转发的 Content-Encoding
+        self.encoding = None            # 实际原样转发的编码
+        self.resp = None
+        self.error = None
+        self.timeout = None  # 'connect' / 'ttfb' / 'idle'
+        self.broken = None   # 转发过程中中断的异常
+        self.first_chunk = b''
+        self.ttfb = None
+        self.events = 0            # 流式响应已转发的 SSE 事件数
+        self.first_byte_at = None
+        self.completed_at = None   # 响应体完整读完的时间
+        self._chunks = None
+        self._lock = Lock()
+        self._finished = False
+        self._cancelled = False
+        self._closed = False
+        self._conn = None
+        self.abandoned = False     # open() 结束时已被取消，结果由 open() 的调用方处理
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None and self.resp is not None and self.resp.status_code < 400
+
+    def open(self, send):
+        """send() 需以 stream=True 发起请求；成功时读取首个数据块。"""
+        started = time.monotonic()
+        try:
+            with upstream.on_checkout(self._bind):
+                self.resp = send()
+            if self.resp.status_code < 400:
+                encoding = self.resp.headers.get('Content-Encoding', '').strip().lower()
+                if encoding and encoding in self.passthrough:
+                    self.encoding = encoding
+                    self._chunks = self.resp.raw.stream(self.chunk_size, decode_content=False)
+                else:
+                    self._chunks = self.resp.iter_content(chunk_size=self.chunk_size)
+                self.first_chunk = next(self._chunks, b'')
+                self.first_byte_at = time.monotonic()
+                self.ttfb = self.first_byte_at - started
+                if self.idle_timeout:
+                    _set_read_timeout(self.resp, self.idle_timeout)
+        except Exception as e:
+            self.error = e
+            kind = timeout_kind(e)
+            if kind is not None:
+                self.timeout = 'connect' if kind == 'connect' else 'ttfb'
+                count_timeout(self.token, self.timeout)
+        with self._lock:
+            self._finished = True
+            self._conn = None
+            cancelled = self._cancelled
+        if cancelled:
+            self.abandoned = True
+            self.close()
+        return self
+
+    def _bind(self, conn):
+        with self._lock:
+            self._conn = conn
+            cancelled = self._cancelled
+        if cancelled:
+            upstream.abort_connection(conn)
+
+    def body(self):
+        """按顺序产出响应体（包括已经读出的首个数据块）。
+
+        上游在中途断开或超过 idle 期限时结束迭代，异常记录在 self.broken。
+        """
+        stream = self.idle_timeout is not None
+        if self.first_chunk:
+            if stream:
+                self.events += self.first_chunk.count(b'data:')
+            yield self.first_chunk
+        if self._chunks is None:
+            return
+        try:
+            for chunk in self._chunks:
+                if chunk:
+                    if stream:
+                        self.events += chunk.count(b'data:')
+                    yield chunk
+            self.completed_at = time.monotonic()
+        except (requests.exceptions.RequestException, Urllib3Error) as e:
+            if self._closed:
+                return
+            self.broken = e
+            if timeout_kind(e) == 'read':
+                self.timeout = 'idle'
+                count_timeout(self.token, 'idle')
+                logger.warning(f"Token {self.token.id} stream idle for over {self.idle_timeout}s, closing response")
+            else:
+                logger.warning(f"Token {self.token.id} stream broke: {e}")
+
+    def error_body(self, limit: int) -> bytes:
+        """读取错误响应体，最多 limit 字节。"""
+        out = bytearray()
+        try:
+            for chunk in self.resp.iter_content(chunk_size=8192):
+                out += chunk
+                if len(out) >= limit:
+                    break
+        except (requests.exceptions.RequestException, Urllib3Error):
+            pass
+        return bytes(out[:limit])
+
+    def cancel(self) -> bool:
+        """放弃这次尝试：立即归还并发名额并中止进行中的上游请求。
+
+        返回 open() 是否已经结束：已结束时尝试的结果由 cancel() 的调用方处理，
+        否则 open() 结束时设置 abandoned，由 open() 的调用方处理。
+        """
+        with self._lock:
+            self._cancelled = True
+            finished = self._finished
+            conn = self._conn
+        if finished:
+            self.close()
+            return True
+        self.lease.release()
+        if conn is not None:
+            upstream.abort_connection(conn)
+        return False
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        if self.resp is not None:
+            self.resp.close()
+        self.lease.release()
+        if self.ok and self.ttfb is not None:
+            for hook in _complete_hooks:
+                hook(self)
@@ -0,0 +1,134 @@
+"""按 token 跟踪上游限流状态（纯内存，不写数据库）。
+
+- 429 时按 Retry-After / x-ratelimit-reset 设置冷却期，冷却中的 token 不参与选号；
+- 根据 x-ratelimit-remaining / limit / reset 估算剩余配额：未返回的在途请求会占用配额，
+  窗口内按时间线性回补，到 reset 时恢复满额。快耗尽的 token 排到候选列表最后。
+"""
+import re
+import time
+from email.utils import parsedate_to_datetime
+from threading import Lock
+
+import settings
+from token_pool import TokenRecord
+
+_lock = Lock()
+
+_REMAINING_HEADERS = ('x-ratelimit-remaining-requests', 'x-ratelimit-remaining', 'ratelimit-remaining')
+_LIMIT_HEADERS = ('x-ratelimit-limit-requests', 'x-ratelimit-limit', 'ratelimit-limit')
+_RESET_HEADERS = ('x-ratelimit-reset-requests', 'x-ratelimit-reset', 'ratelimit-reset')
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def _first_header(headers, names):
+    for name in names:
+        value = headers.get(name)
+        if value not in (None, ''):
+            return value
+    return None
+
+
+def parse_delay(value) -> float | None:
+    """把 Retry-After / reset 头解析为距现在的秒数。
+
+    支持秒数、Unix 时间戳（秒/毫秒）、"1m30s"/"250ms" 形式的时长以及 HTTP 日期。
+    """
+    if value is None:
+        return None
+    text = str(value).strip()
+    try:
+        number = float(text)
+    except ValueError:
+        number = None
+    if number is not None:
+        if number > 1e12:
+            return max(0.0, number / 1000 - time.time())
+        if number > 1e9:
+            return max(0.0, number - time.time())
+        return max(0.0, number)
+    parts = _DURATION_RE.findall(text)
+    if parts and ''.join(n + u for n, u in parts) == text.replace(' ', ''):
+        return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+    try:
+        return max(0.0, parsedate_to_datetime(text).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_int(value) -> int | None:
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def observe(record: TokenRecord, status_code: int, headers) -> float | None:
+    """记录一次上游响应的限流信息；若进入冷却返回冷却秒数。"""
+    now = time.monotonic()
+    remaining = _parse_int(_first_header(headers, _REMAINING_HEADERS))
+    limit = _parse_int(_first_header(headers, _LIMIT_HEADERS))
+    reset = parse_delay(_first_header(headers, _RESET_HEADERS))
+    cooldown = None
+    if status_code == 429:
+        cooldown = parse_delay(headers.get('Retry-After'))
+        if cooldown is None:
+            cooldown = reset if reset is not None else settings.RATE_LIMIT_DEFAULT_COOLDOWN
+    elif remaining is not None and remaining <= 0 and reset:
+        # 配额已用完但本次请求成功：下一个请求必然 429，直接冷却到 reset
+        cooldown = reset
+    with _lock:
+        if remaining is not None:
+            record.rl_remaining = remaining
+            record.rl_limit = limit if limit is not None else record.rl_limit
+            record.rl_observed_at = now
+            record.rl_reset_at = now + reset if reset is not None else None
+        if cooldown is not None:
+            cooldown = min(cooldown, settings.RATE_LIMIT_MAX_COOLDOWN)
+            record.cooldown_until = max(record.cooldown_until, now + cooldown)
+    return cooldown
+
+
+def cooldown_remaining(record: TokenRecord) -> float:
+    return max(0.0, record.cooldown_until - time.monotonic())
+
+
+def is_cooling(record: TokenRecord) -> bool:
+    return record.cooldown_until > time.monotonic()
+
+
+def estimated_remaining(record: TokenRecord) -> float | None:
+    """预测当前剩余配额；没有限流头信息时返回 None。"""
+    remaining = record.rl_remaining
+    if remaining is None:
+        return None
+    now = time.monotonic()
+    limit = record.rl_limit
+    reset_at = record.rl_reset_at
+    if reset_at is not None and now >= reset_at:
+        return float(limit) if limit is not None else None
+    estimate = float(remaining)
+    if limit is not None and reset_at is not None and reset_at > record.rl_observed_at:
+        window = reset_at - record.rl_observed_at
+        estimate += (limit - remaining) * (now - record.rl_observed_at) / window
+    # 已发出但尚未返回的请求会继续消耗配额
+    return estimate - record.in_flight
+
+
+def near_exhaustion(record: TokenRecord) -> bool:
+    estimate = estimated_remaining(record)
+    if estimate is None:
+        return False
+    if record.rl_limit:
+        return estimate / record.rl_limit < settings.RATE_LIMIT_LOW_WATERMARK
+    return estimate <= 0
+
+
+def snapshot(record: TokenRecord) -> dict:
+    estimate = estimated_remaining(record)
+    return {
+        'cooldown_seconds': round(cooldown_remaining(record), 1),
+        'rate_limit_remaining': round(estimate, 1) if estimate is not None else None,
+        'rate_limit_limit': record.rl_limit,
+        'near_exhaustion': near_exhaustion(record),
+    }
@@ -0,0 +1,60 @@
+"""对话请求体的快速处理：解析一次、原样转发原始字节。
+
+- 用 orjson（可选）解析，只为读取 model / stream 等字段；
+- 转发给上游时直接发送客户端的原始字节，不再 dict 复制和重新序列化；
+- 只有流式转换需要把 stream 改为 true 时才改写请求体：顶层没有 stream 时在开头插入，
+  顶层 stream 为 false / null / 0 且唯一的匹配位于顶层时原位替换，否则退回重新序列化。
+"""
+import re
+
+import sse
+
+_STREAM_FALSE = re.compile(rb'"stream"\s*:\s*(?:false|null|0)(?=\s*[,}])')
+_OBJECT_START = re.compile(rb'\s*\{\s*')
+_NESTING = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+
+class InvalidBody(ValueError):
+    pass
+
+
+def parse(raw: bytes) -> dict:
+    try:
+        payload = sse.loads(raw)
+    except ValueError as e:
+        raise InvalidBody(str(e)) from None
+    if not isinstance(payload, dict):
+        raise InvalidBody('request body must be a JSON object')
+    return payload
+
+
+def with_stream(raw: bytes, payload: dict) -> bytes:
+    """返回 stream 为 true 的请求体字节。"""
+    if payload.get('stream') is True:
+        return raw
+    if 'stream' not in payload:
+        # 用 memoryview 拼接，避免为大请求体多复制一份
+        end = _OBJECT_START.match(raw).end()
+        separator = b'' if raw[end:end + 1] == b'}' else b','
+        view = memoryview(raw)
+        return b''.join((view[:end], b'"stream":true', separator, view[end:]))
+    value = payload['stream']
+    if value is None or value is False or (type(value) is int and value == 0):
+        matches = list(_STREAM_FALSE.finditer(raw))
+        # 字符串里的引号都是转义的，匹配一定是某一层对象的 stream 键；只替换顶层的
+        if len(matches) == 1 and _depth(raw, matches[0].start()) == 1:
+            match = matches[0]
+            return b''.join((raw[:match.start()], b'"stream":true', raw[match.end():]))
+    return sse.dumps(dict(payload, stream=True))
+
+
+def _depth(raw: bytes, end: int) -> int:
+    """raw[:end] 结束处的对象 / 数组嵌套层数（跳过字符串）。"""
+    depth = 0
+    for token in _NESTING.finditer(raw, 0, end):
+        char = token.group()
+        if char in (b'{', b'['):
+            depth += 1
+        elif char in (b'}', b']'):
+            depth -= 1
+    return depth
@@ -0,0 +1,299 @@
+"""确定性对话请求的响应缓存（SystemConfig.cache_enabled / cache_timeout）。
+
+- 只缓存确定性请求：temperature 为 0，或请求头 X-Response-Cache: 1 显式开启
+  （X-Response-Cache: 0 可跳过缓存）；
+- 缓存键为调用方 Key、模型、消息、工具和采样参数的规范化 JSON 的 SHA-256，不同调用方的
+  响应互不共享；命中的请求不计入调用方的 TPM 用量；
+- 内存中 LRU + TTL，总大小受 RESPONSE_CACHE_MAX_BYTES 限制；设置 RESPONSE_CACHE_DIR
+  后同时写入磁盘，内存未命中时从磁盘读取；
+- 缓存内容是非流式 chat.completion JSON，流式客户端命中时由 sse.synthesize_body 回放。
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+import settings
+import sse
+
+logger = logging.getLogger(__name__)
+
+OPT_IN_HEADER = 'X-Response-Cache'
+
+# 影响输出内容的请求字段；stream / stream_options / user 等不影响结果，不参与缓存键
+_KEY_FIELDS = (
+    'model', 'messages', 'tools', 'tool_choice', 'functions', 'function_call', 'parallel_tool_calls',
+    'temperature', 'top_p', 'top_k', 'n', 'max_tokens', 'max_completion_tokens', 'stop', 'seed',
+    'presence_penalty', 'frequency_penalty', 'logit_bias', 'logprobs', 'top_logprobs',
+    'response_format', 'reasoning_effort',
+)
+
+
+def cache_key(payload: dict, headers, client_id: int) -> str | None:
+    """返回缓存键；请求不可缓存时返回 None。client_id 为调用方 Key 的 id。"""
+    opt_in = (headers.get(OPT_IN_HEADER) or '').strip().lower()
+    if opt_in in ('0', 'false', 'off', 'no'):
+        return None
+    explicit = opt_in in ('1', 'true', 'on', 'yes')
+    temperature = payload.get('temperature')
+    if not explicit and not (isinstance(temperature, (int, float)) and temperature == 0):
+        return None
+    canonical = {name: payload[name] for name in _KEY_FIELDS if name in payload}
+    try:
+        raw = json.dumps(canonical, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    except (TypeError, ValueError):
+        return None
+    raw = f"{client_id}\n{raw}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self):
+        self._lock = Lock()
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = None
+        self._stats = {
+            'hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0,
+            'evictions': 0, 'expirations': 0, 'disk_evictions': 0,
+        }
+
+    # --- 内存层 ---
+
+    def get(self, key: str) -> bytes | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, body = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return body
+                self._remove(key)
+                self._stats['expirations'] += 1
+        body, expires_at = self._disk_get(key, now)
+        with self._lock:
+            if body is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['disk_hits'] += 1
+            self._insert(key, body, expires_at)
+        return body
+
+    def put(self, key: str, body: bytes, ttl: float):
+        if ttl <= 0 or len(body) > settings.RESPONSE_CACHE_MAX_BYTES:
+            return
+        expires_at = time.time() + ttl
+        with self._lock:
+            self._insert(key, body, expires_at)
+            self._stats['stores'] += 1
+        self._disk_put(key, body, expires_at)
+
+    def put_completion(self, key: str, completion: dict | bytes, ttl: float):
+        """只缓存成功的 chat.completion。"""
+        if isinstance(completion, (bytes, bytearray)):
+            try:
+                parsed = sse.loads(completion)
+            except ValueError:
+                return
+            body = bytes(completion)
+        else:
+            parsed, body = completion, sse.dumps(completion)
+        if not isinstance(parsed, dict) or not parsed.get('choices') or parsed.get('error'):
+            return
+        self.put(key, body, ttl)
+
+    def _insert(self, key: str, body: bytes, expires_at: float):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (expires_at, body)
+        self._bytes += len(body)
+        while self._bytes > settings.RESPONSE_CACHE_MAX_BYTES and self._entries:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self._stats['evictions'] += 1
+
+    def _remove(self, key: str):
+        _, body = self._entries.pop(key)
+        self._bytes -= len(body)
+
+    def clear(self):
+        """清空内存层和磁盘层。"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if settings.RESPONSE_CACHE_DIR:
+            self._disk_clear()
+
+    # --- 磁盘层（文件首行为过期时间戳） ---
+
+    def _path(self, key: str) -> str:
+        return os.path.join(settings.RESPONSE_CACHE_DIR, key[:2], key)
+
+    def _disk_get(self, key: str, now: float):
+        if not settings.RESPONSE_CACHE_DIR:
+            return None, None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires_at = float(f.readline())
+                body = f.read()
+        except (OSError, ValueError):
+            return None, None
+        if expires_at <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None, None
+        return body, expires_at
+
+    def _disk_put(self, key: str, body: bytes, expires_at: float):
+        if not settings.RESPONSE_CACHE_DIR:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(f"{expires_at}\n".encode('ascii'))
+                f.write(body)
+            os.replace(tmp, path)
+        except OSError as e:
+            logger.warning(f"Response cache disk write failed: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += len(body)
+            over = self._disk_bytes is None or self._disk_bytes > settings.RESPONSE_CACHE_DISK_MAX_BYTES
+        if over:
+            self._disk_prune()
+
+    def _disk_prune(self):
+        """删除过期文件；仍超过上限时按最近修改时间从旧到新删除。"""
+        now = time.time()
+        files = []
+        for root, _, names in os.walk(settings.RESPONSE_CACHE_DIR):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                    with open(path, 'rb') as f:
+                        expires_at = float(f.readline())
+                except (OSError, ValueError):
+                    continue
+                if expires_at <= now:
+                    self._unlink(path)
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        limit = settings.RESPONSE_CACHE_DISK_MAX_BYTES
+        while files and total > limit:
+            _, size, path = files.pop(0)
+            self._unlink(path)
+            total -= size
+            with self._lock:
+                self._stats['disk_evictions'] += 1
+        with self._lock:
+            self._disk_bytes = total
+
+    def _disk_clear(self):
+        """删除所有分片目录（键的前两位）中的缓存文件，目录中的其他文件不动。"""
+        root = settings.RESPONSE_CACHE_DIR
+        try:
+            shards = [name for name in os.listdir(root)
+                      if len(name) == 2 and all(ch in '0123456789abcdef' for ch in name)]
+        except OSError:
+            shards = []
+        for shard in shards:
+            shard_dir = os.path.join(root, shard)
+            try:
+                names = os.listdir(shard_dir)
+            except OSError:
+                continue
+            for name in names:
+                self._unlink(os.path.join(shard_dir, name))
+            try:
+                os.rmdir(shard_dir)
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = 0
+
+    @staticmethod
+    def _unlink(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._stats)
+            out['entries'] = len(self._entries)
+            out['bytes'] = self._bytes
+            out['disk_bytes'] = self._disk_bytes
+        lookups = out['hits'] + out['disk_hits'] + out['misses']
+        out['hit_rate'] = round((out['hits'] + out['disk_hits']) / lookups, 3) if lookups else 0.0
+        out['max_bytes'] = settings.RESPONSE_CACHE_MAX_BYTES
+        out['disk_dir'] = settings.RESPONSE_CACHE_DIR or None
+        return out
+
+
+def record_stream(chunks, key: str, ttl: float):
+    """转发流式响应的同时聚合内容；正常结束（有 finish_reason）时写入缓存。"""
+    decoder = sse.SSEDecoder()
+    aggregator = sse.StreamAggregator()
+    recording = True
+    finished = False
+    try:
+        for chunk in chunks:
+            if recording:
+                try:
+                    for data in decoder.feed(chunk):
+                        if data == sse.DONE or not data:
+                            continue
+                        parsed = sse.loads(data)
+                        if isinstance(parsed, dict):
+                            aggregator.add(parsed)
+                            finished = finished or any(
+                                c.get('finish_reason') is not None for c in parsed.get('choices') or ())
+                except (ValueError, sse.AggregateTooLarge):
+                    recording = False
+            yield chunk
+    finally:
+        # 客户端断开时立即关闭上游生成器，归还连接
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    if recording and finished:
+        cache.put_completion(key, aggregator.result(), ttl)
+
+
+def record_body(chunks, key: str, ttl: float):
+    """逐块转发非流式响应体的同时收集内容；完整且不超过缓存上限时写入缓存。"""
+    parts = []
+    size = 0
+    keep = True
+    try:
+        for chunk in chunks:
+            if keep:
+                size += len(chunk)
+                if size > settings.RESPONSE_CACHE_MAX_BYTES:
+                    keep = False
+                    parts = []
+                else:
+                    parts.append(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    if keep:
+        cache.put_completion(key, b''.join(parts), ttl)
+
+
+cache = ResponseCache()
@@ -2,7 +2,8 @@ import logging
 import time
 from datetime import datetime, timedelta
 from extensions import db
-from models import Token, SystemConfig, RequestLog
+from models import Token, RequestLog
+import config_cache
 from zai_token import DiscordOAuthHandler
 import jwt # pyjwt
 from flask import current_app
@@ -11,7 +12,7 @@ logger = logging.getLogger(__name__)
 
 def get_zai_handler():
     # Assume we are in app context so we can query SystemConfig
-    config = SystemConfig.query.first()
+    config = config_cache.get()
     handler = DiscordOAuthHandler()
     if config and config.proxy_enabled and config.proxy_url:
         handler.session.proxies = {
@@ -89,7 +90,7 @@ def update_token_info(token_id, use_oauth=False, skip_darkknight=False):
              token.zai_darkknight = darkknight
          token.remark = f"Updated via {source} (Session Auth)"
          # For SESSION_AUTH, set expiry based on system config
-         config = SystemConfig.query.first()
+         config = config_cache.get()
          refresh_interval = config.token_refresh_interval if config else 3600
          token.at_expires = datetime.now() + timedelta(seconds=refresh_interval)
          db.session.commit()
@@ -104,7 +105,7 @@ def update_token_info(token_id, use_oauth=False, skip_darkknight=False):
     token.remark = f"Updated via {source}"
     
     # Get system config for fallback expiry
-    config = SystemConfig.query.first()
+    config = config_cache.get()
     refresh_interval = config.token_refresh_interval if config else 3600
     now = datetime.now()
     desired_exp = now + timedelta(seconds=refresh_interval)
@@ -187,7 +188,7 @@ def create_or_update_token_from_oauth():
     token.remark = f"Updated via OAuth login ({source})"
     
     # 设置过期时间（与配置刷新间隔对齐）
-    config = SystemConfig.query.first()
+    config = config_cache.get()
     refresh_interval = config.token_refresh_interval if config else 3600
     now = datetime.now()
     desired_exp = now + timedelta(seconds=refresh_interval)
@@ -0,0 +1,135 @@
+"""运行参数：全部来自环境变量，未设置时使用默认值。"""
+import os
+
+
+def env_str(name: str, default: str) -> str:
+    value = os.environ.get(name)
+    return value if value not in (None, '') else default
+
+
+def env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def env_bool(name: str, default: bool) -> bool:
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# --- 上游连接池 ---
+ZAI_BASE_URL = env_str('ZAI_BASE_URL', 'https://zai.is')
+UPSTREAM_POOL_SIZE = env_int('UPSTREAM_POOL_SIZE', 64)       # 每个上游主机保持的 keep-alive 连接数
+UPSTREAM_POOL_PREWARM = env_int('UPSTREAM_POOL_PREWARM', 4)  # 启动时预先建立的 TLS 连接数
+UPSTREAM_HTTP2 = env_bool('UPSTREAM_HTTP2', False)           # 需要 urllib3>=2.3 且安装 h2
+UPSTREAM_CONNECT_TIMEOUT = env_float('UPSTREAM_CONNECT_TIMEOUT', 10)  # 建立连接的最长等待秒数
+UPSTREAM_TTFB_TIMEOUT = env_float('UPSTREAM_TTFB_TIMEOUT', 60)        # 流式请求等待首个数据块的秒数
+UPSTREAM_IDLE_TIMEOUT = env_float('UPSTREAM_IDLE_TIMEOUT', 60)        # 流式响应两个数据块之间的最长间隔
+UPSTREAM_READ_TIMEOUT = env_float('UPSTREAM_READ_TIMEOUT', 600)       # 非流式请求等待完整响应的秒数
+MAX_REQUEST_BODY_BYTES = env_int('MAX_REQUEST_BODY_BYTES', 32 * 1024 * 1024)  # 请求体大小上限，超出返回 413；0 表示不限制
+UPSTREAM_ERROR_BODY_MAX = env_int('UPSTREAM_ERROR_BODY_MAX', 64 * 1024)         # 上游错误响应体最多保留的字节数
+
+# --- 请求日志异步写入 ---
+LOG_QUEUE_SIZE = env_int('LOG_QUEUE_SIZE', 10000)
+LOG_BATCH_SIZE = env_int('LOG_BATCH_SIZE', 500)
+LOG_FLUSH_INTERVAL = env_float('LOG_FLUSH_INTERVAL', 1.0)        # 秒
+LOG_OVERFLOW_POLICY = env_str('LOG_OVERFLOW_POLICY', 'drop')     # drop / sample / block
+LOG_SAMPLE_RATE = env_float('LOG_SAMPLE_RATE', 0.1)              # sample 策略下队列接近满时的接收比例
+LOG_BLOCK_TIMEOUT = env_float('LOG_BLOCK_TIMEOUT', 0.5)          # block 策略下最多等待秒数
+
+# --- Token 健康状态写回 ---
+TOKEN_HEALTH_FLUSH_INTERVAL = env_int('TOKEN_HEALTH_FLUSH_INTERVAL', 5)  # 秒
+
+# --- 选号策略 ---
+TOKEN_SELECTION_STRATEGY = env_str('TOKEN_SELECTION_STRATEGY', 'round_robin')  # round_robin / least_in_flight / weighted / latency
+
+# --- 限流冷却 ---
+RATE_LIMIT_DEFAULT_COOLDOWN = env_float('RATE_LIMIT_DEFAULT_COOLDOWN', 30)   # 429 未给出 Retry-After 时的冷却秒数
+RATE_LIMIT_MAX_COOLDOWN = env_float('RATE_LIMIT_MAX_COOLDOWN', 600)
+RATE_LIMIT_LOW_WATERMARK = env_float('RATE_LIMIT_LOW_WATERMARK', 0.1)      # 预计剩余配额低于该比例时降低优先级
+
+# --- 熔断 ---
+CIRCUIT_WINDOW_SECONDS = env_float('CIRCUIT_WINDOW_SECONDS', 60)   # 错误率滑动窗口
+CIRCUIT_WINDOW_SIZE = env_int('CIRCUIT_WINDOW_SIZE', 100)          # 窗口内最多保留的请求结果数
+CIRCUIT_MIN_REQUESTS = env_int('CIRCUIT_MIN_REQUESTS', 5)          # 窗口内请求数达到该值才按错误率熔断
+CIRCUIT_ERROR_RATE = env_float('CIRCUIT_ERROR_RATE', 0.5)
+CIRCUIT_BASE_BACKOFF = env_float('CIRCUIT_BASE_BACKOFF', 30)       # 首次熔断后的探测等待秒数，之后逐次加倍
+CIRCUIT_MAX_BACKOFF = env_float('CIRCUIT_MAX_BACKOFF', 1800)
+
+# --- 对冲请求 ---
+HEDGE_ENABLED = env_bool('HEDGE_ENABLED', False)
+HEDGE_PERCENTILE = env_float('HEDGE_PERCENTILE', 95)      # 超过近期 TTFB 的该分位仍无首字节时发起对冲
+HEDGE_MIN_DELAY = env_float('HEDGE_MIN_DELAY', 0.5)       # 对冲前的最短等待秒数
+HEDGE_MIN_SAMPLES = env_int('HEDGE_MIN_SAMPLES', 20)      # TTFB 样本不足时不对冲
+HEDGE_BUDGET_RATIO = env_float('HEDGE_BUDGET_RATIO', 0.05)  # 对冲请求数最多占请求数的比例
+HEDGE_BUDGET_BURST = env_int('HEDGE_BUDGET_BURST', 10)
+
+# --- 流式续写 ---
+STREAM_RESUME_ENABLED = env_bool('STREAM_RESUME_ENABLED', False)  # 上游流中途断开时换 token 续写
+STREAM_RESUME_MAX = env_int('STREAM_RESUME_MAX', 2)               # 单个请求最多续写次数
+
+# --- 流式 / 非流式转换 ---
+STREAM_AGGREGATE_MAX_CHARS = env_int('STREAM_AGGREGATE_MAX_CHARS', 4 * 1024 * 1024)  # 聚合内容上限（字符数），0 表示不限制
+STREAM_SYNTH_CHUNK_CHARS = env_int('STREAM_SYNTH_CHUNK_CHARS', 16)  # 非流式响应转 SSE 时每个数据块的字符数，0 表示不切分
+
+# --- 响应缓存（由管理面板的 cache_enabled / cache_timeout 控制开关和有效期） ---
+RESPONSE_CACHE_MAX_BYTES = env_int('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)   # 内存缓存总大小上限
+RESPONSE_CACHE_DIR = env_str('RESPONSE_CACHE_DIR', '')                             # 磁盘缓存目录，留空不启用
+RESPONSE_CACHE_DISK_MAX_BYTES = env_int('RESPONSE_CACHE_DISK_MAX_BYTES', 1024 * 1024 * 1024)
+
+# --- /v1/models 缓存 ---
+MODELS_CACHE_TTL = env_float('MODELS_CACHE_TTL', 300)                # 超过该秒数后返回旧数据并在后台刷新
+MODELS_REFRESH_INTERVAL = env_float('MODELS_REFRESH_INTERVAL', 600)  # 后台按 token 发现模型的间隔
+MODELS_REFRESH_CONCURRENCY = env_int('MODELS_REFRESH_CONCURRENCY', 4)  # 同时发现模型的 token 数
+MODELS_REFRESH_DEADLINE = env_float('MODELS_REFRESH_DEADLINE', 30)     # 一轮发现的最长秒数，超时的 token 沿用上一次的结果
+
+# --- 相同请求合并 ---
+COALESCE_ENABLED = env_bool('COALESCE_ENABLED', False)
+COALESCE_MAX_BUFFER = env_int('COALESCE_MAX_BUFFER', 4 * 1024 * 1024)  # 每个共享响应的缓冲区上限（字节）
+COALESCE_WAIT_TIMEOUT = env_float('COALESCE_WAIT_TIMEOUT', 60)          # follower 等待 leader 响应头的最长秒数
+
+# --- 调用方限额与公平排队 ---
+PROXY_MAX_CONCURRENCY = env_int('PROXY_MAX_CONCURRENCY', 0)   # 同时转发的对话请求数上限，达到后按调用方权重排队；0 表示不限制
+FAIR_QUEUE_TIMEOUT = env_float('FAIR_QUEUE_TIMEOUT', 30)      # 排队等待转发名额的最长秒数，超时返回 503
+
+# --- 准入排队（所有 token 都在忙或冷却时） ---
+ADMISSION_QUEUE_MAX = env_int('ADMISSION_QUEUE_MAX', 100)            # 排队请求数上限，0 表示不排队、直接返回 503
+ADMISSION_QUEUE_TIMEOUT = env_float('ADMISSION_QUEUE_TIMEOUT', 10)   # 排队等待 token 名额的最长秒数
+ADMISSION_QUEUE_ORDER = env_str('ADMISSION_QUEUE_ORDER', 'fifo')     # fifo / priority（按调用方 Key 的 weight 从高到低）
+
+# --- 请求优先级 ---
+PRIORITY_DEFAULT = env_str('PRIORITY_DEFAULT', 'high')                  # 未指定优先级的请求：high / low
+PRIORITY_RESERVED_SHARE = env_float('PRIORITY_RESERVED_SHARE', 0.2)     # 只给高优先级请求使用的容量比例（每个 token 至少按自适应上限预留）
+TOKEN_CHAT_CONCURRENCY = env_int('TOKEN_CHAT_CONCURRENCY', -1)          # 每个 token 同时处理的对话请求数上限，-1 表示不限制
+
+# --- 自适应并发上限 ---
+ADAPTIVE_LIMIT_ENABLED = env_bool('ADAPTIVE_LIMIT_ENABLED', False)          # 选号时按自适应上限限制每个 token 的在途请求数
+ADAPTIVE_LIMIT_INITIAL = env_float('ADAPTIVE_LIMIT_INITIAL', 4)
+ADAPTIVE_LIMIT_MIN = env_float('ADAPTIVE_LIMIT_MIN', 1)
+ADAPTIVE_LIMIT_MAX = env_float('ADAPTIVE_LIMIT_MAX', 64)
+ADAPTIVE_LIMIT_BACKOFF = env_float('ADAPTIVE_LIMIT_BACKOFF', 0.5)           # 429 / 超时 / 网关错误时上限乘以该系数
+ADAPTIVE_LATENCY_TOLERANCE = env_float('ADAPTIVE_LATENCY_TOLERANCE', 2.0)   # 首字节耗时超过基线的倍数时下调上限
+
+# --- 按延迟选号（TOKEN_SELECTION_STRATEGY=latency） ---
+LATENCY_EWMA_ALPHA = env_float('LATENCY_EWMA_ALPHA', 0.2)          # 首字节耗时 / 吞吐量 EWMA 的平滑系数
+LATENCY_EXPLORATION = env_float('LATENCY_EXPLORATION', 0.1)        # 随机选择其他候选的概率
+LATENCY_PROBE_INTERVAL = env_float('LATENCY_PROBE_INTERVAL', 60)   # 后台探测任务间隔秒数，0 表示不探测
+LATENCY_PROBE_IDLE = env_float('LATENCY_PROBE_IDLE', 300)          # 超过该秒数没有统计的空闲 token 才探测
+LATENCY_PROBE_MODEL = env_str('LATENCY_PROBE_MODEL', '')           # 探测使用的模型，留空取该 token 模型列表中的第一个
+
+# --- 对话粘滞路由 ---
+AFFINITY_ENABLED = env_bool('AFFINITY_ENABLED', False)                # 同一对话的后续请求优先发给上次使用的 token
+AFFINITY_MAX_ENTRIES = env_int('AFFINITY_MAX_ENTRIES', 10000)         # 对话 -> token 映射的条数上限，超出后淘汰最久未用的
+AFFINITY_TTL = env_float('AFFINITY_TTL', 1800)                        # 映射超过该秒数未使用后失效
+AFFINITY_PREFIX_MESSAGES = env_int('AFFINITY_PREFIX_MESSAGES', 1)     # 识别对话时取开头 system 消息之后的前几条消息
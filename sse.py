@@ -0,0 +1,326 @@
+"""增量 SSE 解码与流式响应聚合（流式转非流式）。
+
+- SSEDecoder 直接处理字节块，按 SSE 规范拼接多行 data:，忽略注释行；
+- 安装了 orjson 时用它解析 JSON，否则退回标准库 json；
+- StreamAggregator 合并 content / reasoning_content / tool_calls 参数片段 / logprobs，
+  聚合内容超过 STREAM_AGGREGATE_MAX_CHARS 个字符（每个 logprobs 条目按 1 计）时抛出
+  AggregateTooLarge；SSEDecoder 中未结束的行和事件超过对应字节数时同样抛出；
+- synthesize 反向转换：把非流式 chat.completion 拆成 chat.completion.chunk 事件。
+"""
+import json
+import time
+
+import settings
+
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:  # pragma: no cover - orjson 为可选依赖
+    orjson = None
+
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+DONE = b'[DONE]'
+_BYTES_PER_CHAR = 6  # JSON 中一个字符最多占的字节数（\uXXXX 转义）
+
+
+class AggregateTooLarge(Exception):
+    pass
+
+
+class SSEDecoder:
+    """增量解码 SSE：feed(bytes) 返回本次凑齐的事件的 data（bytes，多行以 \\n 连接）。
+
+    max_bytes 为未结束的行 / 事件的字节数上限，默认按 STREAM_AGGREGATE_MAX_CHARS 换算，0 表示不限制。
+    """
+
+    def __init__(self, max_bytes: int | None = None):
+        if max_bytes is None:
+            max_bytes = settings.STREAM_AGGREGATE_MAX_CHARS * _BYTES_PER_CHAR
+        self.max_bytes = max_bytes
+        # 未结束的行按块暂存，凑齐换行时再拼接一次，长行分成很多小块到达时不会反复复制
+        self._tail: list[bytes] = []
+        self._tail_size = 0
+        self._data: list[bytes] = []
+        self._data_size = 0
+
+    def _check(self, size: int):
+        if self.max_bytes and size > self.max_bytes:
+            raise AggregateTooLarge(f"pending SSE event exceeds {self.max_bytes} bytes")
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        if self._tail:
+            if b'\n' not in chunk:
+                self._tail.append(chunk)
+                self._tail_size += len(chunk)
+                self._check(self._tail_size)
+                return []
+            self._tail.append(chunk)
+            chunk = b''.join(self._tail)
+            self._tail = []
+            self._tail_size = 0
+        lines = chunk.split(b'\n')
+        tail = lines.pop()
+        if tail:
+            self._tail.append(tail)
+            self._tail_size = len(tail)
+            self._check(self._tail_size)
+        events = []
+        data = self._data
+        size = self._data_size
+        for line in lines:
+            if line[-1:] == b'\r':
+                line = line[:-1]
+            if not line:
+                if data:
+                    events.append(data[0] if len(data) == 1 else b'\n'.join(data))
+                    data = []
+                    size = 0
+            elif line[:5] == b'data:':
+                line = line[5:]
+                if line[:1] == b' ':
+                    line = line[1:]
+                data.append(line)
+                size += len(line)
+            # event: / id: / retry: / 注释行对聚合没有意义，忽略
+        self._data = data
+        self._data_size = size
+        self._check(size)
+        return events
+
+    def close(self) -> list[bytes]:
+        """流结束：处理最后一行及未以空行结束的事件。"""
+        events = self.feed(b'\n\n') if self._tail or self._data else []
+        self._tail = []
+        self._tail_size = 0
+        return events
+
+
+def iter_events(chunks, max_bytes: int | None = None):
+    decoder = SSEDecoder(max_bytes)
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
+
+
+class _Choice:
+    __slots__ = ('role', 'content', 'reasoning', 'tool_calls', 'logprobs', 'finish_reason')
+
+    def __init__(self):
+        self.role = None
+        self.content: list[str] = []
+        self.reasoning: list[str] = []
+        self.tool_calls: dict[int, dict] = {}
+        self.logprobs = None
+        self.finish_reason = None
+
+
+class StreamAggregator:
+    def __init__(self, max_chars: int | None = None):
+        self.max_chars = settings.STREAM_AGGREGATE_MAX_CHARS if max_chars is None else max_chars
+        self.size = 0
+        self.first = None
+        self.usage = None
+        self.system_fingerprint = None
+        self.choices: dict[int, _Choice] = {}
+
+    def _grow(self, n: int):
+        self.size += n
+        if self.max_chars and self.size > self.max_chars:
+            raise AggregateTooLarge(f"aggregated response exceeds {self.max_chars} characters")
+
+    def add(self, chunk: dict):
+        if self.first is None:
+            self.first = chunk
+        if chunk.get('usage'):
+            self.usage = chunk['usage']
+        if chunk.get('system_fingerprint'):
+            self.system_fingerprint = chunk['system_fingerprint']
+        for raw in chunk.get('choices') or ():
+            idx = int(raw.get('index', 0))
+            choice = self.choices.get(idx)
+            if choice is None:
+                choice = self.choices[idx] = _Choice()
+            delta = raw.get('delta')
+            if delta:
+                content = delta.get('content')
+                if content:
+                    self._grow(len(content))
+                    choice.content.append(content)
+                if len(delta) > 1 or content is None:
+                    self._add_delta_extras(choice, delta)
+            logprobs = raw.get('logprobs')
+            if logprobs:
+                self._merge_logprobs(choice, logprobs)
+            if raw.get('finish_reason') is not None:
+                choice.finish_reason = raw['finish_reason']
+
+    def _add_delta_extras(self, choice: _Choice, delta: dict):
+        if delta.get('role'):
+            choice.role = delta['role']
+        reasoning = delta.get('reasoning_content')
+        if reasoning:
+            self._grow(len(reasoning))
+            choice.reasoning.append(reasoning)
+        for call in delta.get('tool_calls') or ():
+            self._merge_tool_call(choice, call)
+
+    def _merge_tool_call(self, choice: _Choice, call: dict):
+        idx = int(call.get('index', len(choice.tool_calls)))
+        merged = choice.tool_calls.get(idx)
+        if merged is None:
+            merged = choice.tool_calls[idx] = {'id': None, 'type': 'function', 'function': {'name': '', 'arguments': []}}
+        if call.get('id'):
+            merged['id'] = call['id']
+        if call.get('type'):
+            merged['type'] = call['type']
+        function = call.get('function') or {}
+        if function.get('name'):
+            merged['function']['name'] += function['name']
+        arguments = function.get('arguments')
+        if arguments:
+            self._grow(len(arguments))
+            merged['function']['arguments'].append(arguments)
+
+    def _merge_logprobs(self, choice: _Choice, logprobs: dict):
+        if choice.logprobs is None:
+            choice.logprobs = {}
+        for key, items in logprobs.items():
+            if isinstance(items, list):
+                self._grow(len(items))
+                choice.logprobs.setdefault(key, []).extend(items)
+            else:
+                choice.logprobs[key] = items
+
+    def result(self, fallback_model: str | None = None) -> dict:
+        first = self.first or {}
+        choices_out = []
+        for idx in sorted(self.choices) or [0]:
+            choice = self.choices.get(idx) or _Choice()
+            message = {
+                'role': choice.role or 'assistant',
+                'content': ''.join(choice.content),
+            }
+            if choice.reasoning:
+                message['reasoning_content'] = ''.join(choice.reasoning)
+            if choice.tool_calls:
+                message['tool_calls'] = [
+                    {
+                        'id': call['id'],
+                        'type': call['type'],
+                        'function': {'name': call['function']['name'], 'arguments': ''.join(call['function']['arguments'])},
+                    }
+                    for _, call in sorted(choice.tool_calls.items())
+                ]
+                if not message['content']:
+                    message['content'] = None
+            out = {
+                'index': idx,
+                'message': message,
+                'finish_reason': choice.finish_reason or ('tool_calls' if choice.tool_calls else 'stop'),
+            }
+            if choice.logprobs is not None:
+                out['logprobs'] = choice.logprobs
+            choices_out.append(out)
+
+        result = {
+            'id': first.get('id') or f"chatcmpl-{int(time.time()*1000)}",
+            'object': 'chat.completion',
+            'created': first.get('created') or int(time.time()),
+            'model': first.get('model') or fallback_model or 'unknown',
+            'choices': choices_out,
+        }
+        if self.system_fingerprint:
+            result['system_fingerprint'] = self.system_fingerprint
+        if self.usage is not None:
+            result['usage'] = self.usage
+        return result
+
+
+def aggregate(chunks, fallback_model: str | None = None, max_chars: int | None = None) -> dict:
+    """把上游 SSE 字节流聚合为一个 chat.completion 响应。"""
+    aggregator = StreamAggregator(max_chars)
+    for data in iter_events(chunks, aggregator.max_chars * _BYTES_PER_CHAR):
+        if not data:
+            continue
+        if data == DONE:
+            break
+        try:
+            chunk = loads(data)
+        except ValueError:
+            continue
+        if isinstance(chunk, dict):
+            aggregator.add(chunk)
+    return aggregator.result(fallback_model)
+
+
+def _event(obj) -> bytes:
+    return b'data: ' + dumps(obj) + b'\n\n'
+
+
+def _pieces(text: str, size: int):
+    if size <= 0 or len(text) <= size:
+        yield text
+        return
+    for i in range(0, len(text), size):
+        yield text[i:i + size]
+
+
+def synthesize(completion: dict, chunk_chars: int | None = None):
+    """把 chat.completion 响应转换为 SSE 事件，content / reasoning_content 按 chunk_chars 个字符切分。"""
+    size = settings.STREAM_SYNTH_CHUNK_CHARS if chunk_chars is None else chunk_chars
+    base = {
+        'id': completion.get('id') or f"chatcmpl-{int(time.time()*1000)}",
+        'object': 'chat.completion.chunk',
+        'created': completion.get('created') or int(time.time()),
+        'model': completion.get('model') or 'unknown',
+    }
+    if completion.get('system_fingerprint'):
+        base['system_fingerprint'] = completion['system_fingerprint']
+
+    def chunk(index, delta, finish_reason=None, **extra):
+        return _event(dict(base, choices=[dict({'index': index, 'delta': delta, 'finish_reason': finish_reason}, **extra)]))
+
+    choices = completion.get('choices') or []
+    for choice in choices:
+        index = choice.get('index', 0)
+        message = choice.get('message') or {}
+        yield chunk(index, {'role': message.get('role') or 'assistant', 'content': ''})
+        for key in ('reasoning_content', 'content'):
+            text = message.get(key)
+            if isinstance(text, str) and text:
+                for piece in _pieces(text, size):
+                    yield chunk(index, {key: piece})
+        for i, call in enumerate(message.get('tool_calls') or []):
+            yield chunk(index, {'tool_calls': [dict(call, index=i)]})
+        extra = {'logprobs': choice['logprobs']} if choice.get('logprobs') else {}
+        yield chunk(index, {}, choice.get('finish_reason') or 'stop', **extra)
+    if completion.get('usage') is not None:
+        yield _event(dict(base, choices=[], usage=completion['usage']))
+    yield b'data: [DONE]\n\n'
+
+
+def synthesize_body(body: bytes, chunk_chars: int | None = None):
+    """上游在流式请求中返回了单个 JSON：是 chat.completion 就拆成数据块，否则（如错误信息）原样作为一个事件。"""
+    try:
+        completion = loads(body)
+    except ValueError:
+        completion = None
+    if isinstance(completion, dict) and completion.get('choices') is not None:
+        yield from synthesize(completion, chunk_chars)
+        return
+    if completion is not None:
+        yield _event(completion)
+    elif body.strip():
+        # SSE 的 data 不能跨行
+        yield b'data: ' + b' '.join(body.split()) + b'\n\n'
+    yield b'data: [DONE]\n\n'
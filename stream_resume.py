@@ -0,0 +1,186 @@
+"""流式响应中途断开后换 token 续写。
+
+上游 SSE 在结束（finish_reason / [DONE]）之前断开时，把已经输出的 assistant 内容作为
+前缀重新请求另一个 token，续写的数据块改写为原始的 id / model 后接到同一个客户端流里。
+为了不把半个事件发给客户端，开启续写时按完整事件（以空行结尾）转发。
+
+上游正常关闭连接但没有给出结束标记时同样视为断开。续写只带上已输出的正文：
+推理内容（reasoning_content）尚未结束或已经输出了 tool_calls 时无法续写，直接结束响应。
+"""
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+_DONE = b'[DONE]'
+
+
+class EventSplitter:
+    """把字节块切分为完整的 SSE 事件；未以空行结束的部分留在 tail。"""
+
+    def __init__(self):
+        self.tail = b''
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        data = self.tail + chunk
+        events = []
+        start = 0
+        while True:
+            lf = data.find(b'\n\n', start)
+            crlf = data.find(b'\r\n\r\n', start)
+            if lf < 0 and crlf < 0:
+                break
+            if crlf >= 0 and (lf < 0 or crlf < lf):
+                end = crlf + 4
+            else:
+                end = lf + 2
+            events.append(data[start:end])
+            start = end
+        self.tail = data[start:]
+        return events
+
+
+def _data_lines(event: bytes):
+    for line in event.splitlines():
+        if line.startswith(b'data:'):
+            yield line[5:].strip()
+
+
+def _complete(event: bytes) -> bool:
+    """event 中的 data 都能解析（不是断开处的半个事件）。"""
+    for data in _data_lines(event):
+        if data == _DONE:
+            continue
+        try:
+            json.loads(data)
+        except ValueError:
+            return False
+    return True
+
+
+class StreamState:
+    """记录已转发给客户端的内容，用于生成续写请求和改写续写数据块。"""
+
+    def __init__(self):
+        self.id = None
+        self.model = None
+        self.created = None
+        self.parts: list[str] = []
+        self.finished = False
+        self.reasoning = False   # 输出过 reasoning_content
+        self.tool_calls = False  # 输出过 tool_calls
+
+    @property
+    def resumable(self) -> bool:
+        """推理内容结束（已开始输出正文）且没有 tool_calls 时才能续写。"""
+        return not self.tool_calls and (bool(self.parts) or not self.reasoning)
+
+    @property
+    def text(self) -> str:
+        return ''.join(self.parts)
+
+    def observe(self, event: bytes):
+        for data in _data_lines(event):
+            if data == _DONE:
+                self.finished = True
+                continue
+            try:
+                chunk = json.loads(data)
+            except ValueError:
+                continue
+            if not isinstance(chunk, dict):
+                continue
+            if self.id is None:
+                self.id = chunk.get('id')
+                self.model = chunk.get('model')
+                self.created = chunk.get('created')
+            for choice in chunk.get('choices') or []:
+                if int(choice.get('index', 0)) != 0:
+                    continue
+                delta = choice.get('delta') or {}
+                content = delta.get('content')
+                if content:
+                    self.parts.append(content)
+                if delta.get('reasoning_content'):
+                    self.reasoning = True
+                if delta.get('tool_calls'):
+                    self.tool_calls = True
+                if choice.get('finish_reason') is not None:
+                    self.finished = True
+
+    def rewrite(self, event: bytes) -> bytes:
+        """把续写事件的 id / model / created 改为原始值，并去掉重复的 role 和推理内容。"""
+        out = []
+        for line in event.rstrip(b'\r\n').splitlines():
+            if line.startswith(b'data:'):
+                data = line[5:].strip()
+                try:
+                    chunk = json.loads(data) if data != _DONE else None
+                except ValueError:
+                    chunk = None
+                if isinstance(chunk, dict):
+                    for key in ('id', 'model', 'created'):
+                        if getattr(self, key) is not None:
+                            chunk[key] = getattr(self, key)
+                    for choice in chunk.get('choices') or []:
+                        delta = choice.get('delta')
+                        if isinstance(delta, dict):
+                            delta.pop('role', None)
+                            delta.pop('reasoning_content', None)
+                    line = b'data: ' + json.dumps(chunk, ensure_ascii=False).encode('utf-8')
+            out.append(line)
+        return b'\n'.join(out) + b'\n\n'
+
+
+def continuation_payload(payload: dict, partial: str) -> dict:
+    """在原请求的消息末尾加上已输出的 assistant 内容作为续写前缀。"""
+    if not partial:
+        return payload
+    resumed = dict(payload)
+    resumed['messages'] = list(payload.get('messages') or []) + [{'role': 'assistant', 'content': partial}]
+    return resumed
+
+
+def resumable(attempt, reopen, max_resumes: int):
+    """转发 attempt 的响应；中途断开时调用 reopen(broken_attempt, partial_text) 取得续写尝试。
+
+    reopen 返回已读到首个数据块的 Attempt，没有可用 token 时返回 None。
+    """
+    state = StreamState()
+    current = attempt
+    resumes = 0
+    try:
+        while True:
+            splitter = EventSplitter()
+            continuing = current is not attempt
+            for chunk in current.body():
+                for event in splitter.feed(chunk):
+                    if continuing:
+                        event = state.rewrite(event)
+                    state.observe(event)
+                    yield event
+            if current.broken is None:
+                tail = splitter.tail
+                if tail and _complete(tail):
+                    tail = state.rewrite(tail) if continuing else tail
+                    state.observe(tail)
+                    yield tail
+                if state.finished:
+                    return
+                # 上游在结束标记之前关闭了连接
+                current.broken = EOFError('upstream closed the stream before finish_reason / [DONE]')
+            # 断开处的半个事件丢弃，由续写重新生成
+            if state.finished or resumes >= max_resumes:
+                return
+            if not state.resumable:
+                logger.warning(f"Token {current.token.id} stream broke during reasoning / tool calls, not resuming")
+                return
+            resumes += 1
+            broken, current = current, None
+            broken.close()
+            current = reopen(broken, state.text)
+            if current is None:
+                return
+    finally:
+        if current is not None:
+            current.close()
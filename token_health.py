@@ -0,0 +1,79 @@
+"""Token 健康状态的写回缓存（write-behind）。
+
+成功/失败计数、最近成功/失败时间和备注先更新在内存 TokenRecord 上（选号立即生效，
+包括认证失败导致的禁用），再由定时任务合并成一次批量 UPDATE 写回数据库。
+"""
+import logging
+from datetime import datetime
+from threading import Lock
+
+from sqlalchemy import update
+
+from extensions import db
+from models import Token
+from token_pool import TokenRecord, pool
+
+logger = logging.getLogger(__name__)
+
+_lock = Lock()
+_dirty: set[int] = set()
+
+
+def mark_success(record: TokenRecord):
+    with _lock:
+        record.last_success_at = datetime.now()
+        if record.error_count:
+            record.error_count = 0
+        _dirty.add(record.id)
+
+
+def mark_error(record: TokenRecord, reason: str, ban: bool = False):
+    """记录一次失败；ban=True 时永久禁用并立即从选号环中移除。"""
+    with _lock:
+        record.error_count = int(record.error_count or 0) + 1
+        record.last_error_at = datetime.now()
+        record.remark = (reason or '')[:1000]
+        if ban:
+            record.remark = f"Auto-banned due to auth failure: {(reason or '')[:950]}"
+        _dirty.add(record.id)
+    if ban:
+        pool.apply(record.id, {'is_active': False})
+
+
+def pending() -> int:
+    return len(_dirty)
+
+
+def flush():
+    """把内存中的健康状态批量写回数据库（需要 app context）。"""
+    with _lock:
+        if not _dirty:
+            return 0
+        ids = list(_dirty)
+        _dirty.clear()
+        rows = []
+        for token_id in ids:
+            record = pool.get(token_id)
+            if record is None:  # 已被删除
+                continue
+            rows.append({
+                'id': record.id,
+                'error_count': record.error_count,
+                'remark': record.remark,
+                'is_active': bool(record.is_active),
+                'last_success_at': record.last_success_at,
+                'last_error_at': record.last_error_at,
+            })
+    if not rows:
+        return 0
+    try:
+        # 按主键的 ORM 批量 UPDATE：一条 executemany，不触发 token_pool 的 mapper 事件
+        db.session.execute(update(Token), rows)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Failed to flush token health for {len(rows)} token(s): {e}")
+        with _lock:
+            _dirty.update(row['id'] for row in rows)
+        return 0
+    return len(rows)
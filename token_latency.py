@@ -0,0 +1,178 @@
+"""按 token 的延迟统计与按延迟选号（TOKEN_SELECTION_STRATEGY=latency）。
+
+- 从实际流量记录每个 token 的流式首字节耗时和吞吐量（每秒 SSE 事件数，约等于每秒输出
+  token 数）的 EWMA；
+- latency 策略按预计耗时（首字节 + 参考长度输出所需时间，再乘以 1 + 在途请求数）从小到大
+  选号，还没有统计的 token 排在最前面；以 LATENCY_EXPLORATION 的概率随机把一个候选提到
+  最前，慢的 token 也会被定期采样；
+- 后台任务定期给空闲超过 LATENCY_PROBE_IDLE 秒的 token 发一个很小的流式请求，保持统计新鲜；
+  熔断未关闭的 token 不探测，半开状态的探测机会留给真实请求（结果才会计入熔断器）。
+
+状态只保存在内存中。
+"""
+import heapq
+import logging
+import random
+import time
+from threading import Lock
+
+import circuit_breaker
+import model_catalog
+import proxy_attempt
+import rate_limits
+import settings
+import sse
+import token_scheduler
+import upstream
+from token_pool import TokenPool, TokenRecord, pool
+
+logger = logging.getLogger(__name__)
+
+_REFERENCE_OUTPUT_TOKENS = 100  # 估算预计耗时时假设的输出长度
+_MIN_EVENTS = 8                 # 事件数太少的响应不计吞吐量
+_MAX_PROBES_PER_RUN = 10
+_PROBE_MAX_TOKENS = 16
+
+_lock = Lock()
+_stats = {'probes': 0, 'probe_failures': 0, 'explorations': 0}
+
+
+def _ewma(current: float | None, sample: float) -> float:
+    if current is None:
+        return sample
+    return current + settings.LATENCY_EWMA_ALPHA * (sample - current)
+
+
+def _on_complete(attempt):
+    if attempt.idle_timeout is None:
+        # 非流式请求的首字节耗时包含整段生成时间，不计入
+        return
+    record = attempt.token
+    with _lock:
+        record.lt_ttfb = _ewma(record.lt_ttfb, attempt.ttfb)
+        if attempt.completed_at is not None and attempt.events >= _MIN_EVENTS:
+            duration = attempt.completed_at - attempt.first_byte_at
+            if duration > 0:
+                record.lt_tps = _ewma(record.lt_tps, attempt.events / duration)
+        record.lt_observed_at = time.monotonic()
+
+
+def expected_seconds(record: TokenRecord) -> float:
+    if record.lt_ttfb is None:
+        # 还没有统计的 token 先试一次
+        return 0.0
+    seconds = record.lt_ttfb
+    if record.lt_tps:
+        seconds += _REFERENCE_OUTPUT_TOKENS / record.lt_tps
+    # 在途请求越多越慢，避免所有请求都压到最快的 token 上
+    return seconds * (1 + record.in_flight)
+
+
+class LatencyStrategy:
+    """优先选择预计耗时最短的 token；以 LATENCY_EXPLORATION 的概率探索其他候选。"""
+    name = 'latency'
+
+    def select(self, token_pool: TokenPool, limit: int, tier_of) -> list[TokenRecord]:
+        ring, start = token_pool.rotate()
+        n = len(ring)
+        ranked = []
+        for i in range(n):
+            record = ring[(start + i) % n]
+            level = tier_of(record)
+            if level is not None:
+                ranked.append((level, expected_seconds(record), i, record))
+        chosen = [item[-1] for item in heapq.nsmallest(limit, ranked)]
+        if len(ranked) > 1 and random.random() < settings.LATENCY_EXPLORATION:
+            best_level = min(item[0] for item in ranked)
+            pick = random.choice([item[-1] for item in ranked if item[0] == best_level])
+            chosen = [pick] + [r for r in chosen if r is not pick][:limit - 1]
+            with _lock:
+                _stats['explorations'] += 1
+        return chosen
+
+
+def _probe_model(record: TokenRecord) -> str | None:
+    if settings.LATENCY_PROBE_MODEL:
+        return settings.LATENCY_PROBE_MODEL
+    if record.models:
+        return min(record.models)
+    catalog = model_catalog.get()
+    return min(catalog.ids) if catalog and catalog.ids else None
+
+
+def _probe(record: TokenRecord, lease, model: str) -> bool:
+    body = sse.dumps({
+        'model': model,
+        'messages': [{'role': 'user', 'content': 'hi'}],
+        'max_tokens': _PROBE_MAX_TOKENS,
+        'stream': True,
+    })
+    headers = {"Authorization": f"Bearer {record.zai_token}", "Content-Type": "application/json"}
+    if record.zai_darkknight:
+        headers["x-zai-darkknight"] = record.zai_darkknight
+    timeout = (settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_TTFB_TIMEOUT)
+    attempt = proxy_attempt.Attempt(record, lease, idle_timeout=settings.UPSTREAM_IDLE_TIMEOUT)
+    try:
+        attempt.open(lambda: upstream.client.post('/api/v1/chat/completions', data=body, headers=headers,
+                                                  stream=True, timeout=timeout))
+        if attempt.resp is not None:
+            rate_limits.observe(record, attempt.resp.status_code, attempt.resp.headers)
+        if not attempt.ok:
+            return False
+        for _ in attempt.body():
+            pass
+        return attempt.broken is None
+    finally:
+        attempt.close()
+
+
+def probe_idle():
+    """给空闲的 token 发探测请求；只在 latency 策略下运行。"""
+    if token_scheduler.get_strategy().name != LatencyStrategy.name:
+        return
+    now = time.monotonic()
+    probed = 0
+    for record in pool.records():
+        if probed >= _MAX_PROBES_PER_RUN:
+            break
+        if not record.usable or record.in_flight or now - record.lt_observed_at < settings.LATENCY_PROBE_IDLE:
+            continue
+        if record.cb_state != circuit_breaker.CLOSED:
+            continue
+        model = _probe_model(record)
+        if not model:
+            continue
+        # 探测请求按低优先级占名额，不使用预留给交互请求的容量
+        lease = token_scheduler.acquire(record, token_scheduler.KIND_CHAT, token_scheduler.PRIORITY_LOW)
+        if lease is None:
+            continue
+        probed += 1
+        try:
+            ok = _probe(record, lease, model)
+        except Exception as e:
+            logger.debug(f"Latency probe for token {record.id} failed: {e}")
+            ok = False
+        with _lock:
+            # 探测失败也要等下一个空闲周期，不反复打到出错的 token
+            record.lt_observed_at = time.monotonic()
+            _stats['probes'] += 1
+            if not ok:
+                _stats['probe_failures'] += 1
+
+
+def snapshot(record: TokenRecord) -> dict:
+    return {
+        'ttfb_ewma': round(record.lt_ttfb, 3) if record.lt_ttfb is not None else None,
+        'throughput_ewma': round(record.lt_tps, 1) if record.lt_tps is not None else None,
+    }
+
+
+def stats() -> dict:
+    with _lock:
+        out = dict(_stats)
+    out['exploration'] = settings.LATENCY_EXPLORATION
+    return out
+
+
+token_scheduler.register_strategy(LatencyStrategy())
+proxy_attempt.on_complete(_on_complete)
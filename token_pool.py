@@ -0,0 +1,213 @@
+"""内存中的 Token 池：启动时从数据库加载一次，之后随 Token 的提交增量更新。
+
+代理请求选号只读内存，不再查询 SQLite。
+"""
+import bisect
+from collections import deque
+from threading import Lock
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+import settings
+from models import Token
+
+_SYNC_FIELDS = (
+    'email', 'discord_token', 'zai_token', 'zai_darkknight', 'is_active', 'error_count', 'remark',
+    'image_enabled', 'video_enabled', 'image_concurrency', 'video_concurrency', 'weight',
+    'last_success_at', 'last_error_at',
+)
+
+# 只存在于内存中的运行时状态（由 token_scheduler / rate_limits / circuit_breaker / proxy_attempt / model_catalog /
+# adaptive_limit / token_latency 维护）
+_RUNTIME_FIELDS = (
+    'in_flight', 'kind_in_flight', 'timeouts', 'models',
+    'cooldown_until', 'rl_remaining', 'rl_limit', 'rl_reset_at', 'rl_observed_at',
+    'cb_state', 'cb_window', 'cb_consecutive_failures', 'cb_open_count', 'cb_open_until', 'cb_probe_in_flight',
+    'al_limit', 'al_latency_short', 'al_latency_long', 'al_decreased_at',
+    'lt_ttfb', 'lt_tps', 'lt_observed_at',
+)
+
+
+class TokenRecord:
+    __slots__ = ('id',) + _SYNC_FIELDS + _RUNTIME_FIELDS
+
+    def __init__(self, token_id: int):
+        self.id = token_id
+        for name in _SYNC_FIELDS:
+            setattr(self, name, None)
+        self.in_flight = 0
+        self.kind_in_flight = {}
+        self.timeouts = {'connect': 0, 'ttfb': 0, 'idle': 0}
+        self.models = None  # 发现到的可用模型（frozenset），None 表示未知
+        self.cooldown_until = 0.0
+        self.rl_remaining = None
+        self.rl_limit = None
+        self.rl_reset_at = None
+        self.rl_observed_at = 0.0
+        self.cb_state = 'closed'
+        self.cb_window = deque(maxlen=max(1, settings.CIRCUIT_WINDOW_SIZE))
+        self.cb_consecutive_failures = 0
+        self.cb_open_count = 0
+        self.cb_open_until = 0.0
+        self.cb_probe_in_flight = False
+        self.al_limit = None  # 自适应并发上限，首次使用时取 ADAPTIVE_LIMIT_INITIAL
+        self.al_latency_short = None
+        self.al_latency_long = None
+        self.al_decreased_at = 0.0
+        self.lt_ttfb = None   # 流式首字节耗时 EWMA（秒）
+        self.lt_tps = None    # 吞吐量 EWMA（每秒 SSE 事件数）
+        self.lt_observed_at = 0.0
+
+    def update_from(self, values: dict):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    @property
+    def usable(self) -> bool:
+        # SESSION_AUTH_COOKIE 等会话型 token 不能直接作为 Bearer 调用 API
+        return bool(self.is_active and self.zai_token and not str(self.zai_token).startswith('SESSION'))
+
+
+def _snapshot(token: Token) -> dict:
+    return {name: getattr(token, name) for name in _SYNC_FIELDS}
+
+
+def _changed(token: Token) -> dict:
+    # 只同步本次真正修改过的字段，避免用数据库里尚未写回的旧健康计数覆盖内存值
+    state = inspect(token)
+    return {name: getattr(token, name) for name in _SYNC_FIELDS if state.attrs[name].history.has_changes()}
+
+
+class TokenPool:
+    def __init__(self):
+        self._lock = Lock()
+        self._records: dict[int, TokenRecord] = {}
+        # 可用 token，按 id 升序；写时复制，读者拿到的列表不会再被修改
+        self._ring: list[TokenRecord] = []
+        self._ring_ids: list[int] = []
+        self._cursor = 0
+
+    def load(self, tokens):
+        with self._lock:
+            self._records = {}
+            for token in tokens:
+                record = TokenRecord(token.id)
+                record.update_from(_snapshot(token))
+                self._records[token.id] = record
+            self._rebuild_ring()
+
+    def _rebuild_ring(self):
+        self._ring = sorted((r for r in self._records.values() if r.usable), key=lambda r: r.id)
+        self._ring_ids = [r.id for r in self._ring]
+
+    def _ring_remove(self, token_id: int):
+        i = bisect.bisect_left(self._ring_ids, token_id)
+        if i < len(self._ring_ids) and self._ring_ids[i] == token_id:
+            self._ring_ids = self._ring_ids[:i] + self._ring_ids[i + 1:]
+            self._ring = self._ring[:i] + self._ring[i + 1:]
+            if self._cursor > i:
+                self._cursor -= 1
+
+    def _ring_add(self, record: TokenRecord):
+        i = bisect.bisect_left(self._ring_ids, record.id)
+        if i < len(self._ring_ids) and self._ring_ids[i] == record.id:
+            return
+        self._ring_ids = self._ring_ids[:i] + [record.id] + self._ring_ids[i:]
+        self._ring = self._ring[:i] + [record] + self._ring[i:]
+        if self._cursor > i:
+            self._cursor += 1
+
+    def apply(self, token_id: int, values: dict | None):
+        """values 为 None 表示 token 已删除；否则只更新 values 中给出的字段。"""
+        with self._lock:
+            if values is None:
+                self._records.pop(token_id, None)
+                self._ring_remove(token_id)
+                return
+            record = self._records.get(token_id)
+            if record is None:
+                record = self._records[token_id] = TokenRecord(token_id)
+            record.update_from(values)
+            if record.usable:
+                self._ring_add(record)
+            else:
+                self._ring_remove(token_id)
+
+    def get(self, token_id: int) -> TokenRecord | None:
+        return self._records.get(token_id)
+
+    def records(self) -> list[TokenRecord]:
+        return list(self._records.values())
+
+    def rotate(self) -> tuple[list[TokenRecord], int]:
+        """返回当前可用环的快照和本次起点，并把游标前移一位（O(1)）。"""
+        with self._lock:
+            ring = self._ring
+            n = len(ring)
+            if n == 0:
+                return ring, 0
+            start = self._cursor % n
+            self._cursor = (start + 1) % n
+            return ring, start
+
+    def candidates(self, limit: int | None = None) -> list[TokenRecord]:
+        """多号轮询：每次从上一次的下一个 token 开始，最多返回 limit 个。"""
+        ring, start = self.rotate()
+        n = len(ring)
+        count = n if limit is None else min(limit, n)
+        return [ring[(start + i) % n] for i in range(count)]
+
+    def __len__(self):
+        return len(self._ring)
+
+
+pool = TokenPool()
+
+
+# --- ORM 钩子：Token 在任何地方（管理接口、刷新任务、错误标记）提交后同步到内存 ---
+
+_PENDING_KEY = 'token_pool_pending'
+
+
+def _queue_change(target: Token, values: dict | None):
+    session = object_session(target)
+    if session is None:
+        pool.apply(target.id, values)
+        return
+    session.info.setdefault(_PENDING_KEY, {})[target.id] = values
+
+
+@event.listens_for(Token, 'after_insert')
+def _on_token_insert(mapper, connection, target):
+    _queue_change(target, _snapshot(target))
+
+
+@event.listens_for(Token, 'after_update')
+def _on_token_update(mapper, connection, target):
+    values = _changed(target)
+    if values:
+        session = object_session(target)
+        pending = session.info.get(_PENDING_KEY, {}).get(target.id) if session is not None else None
+        if pending:
+            pending.update(values)
+            values = pending
+        _queue_change(target, values)
+
+
+@event.listens_for(Token, 'after_delete')
+def _on_token_delete(mapper, connection, target):
+    _queue_change(target, None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _on_commit(session):
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        for token_id, values in pending.items():
+            pool.apply(token_id, values)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _on_rollback(session):
+    session.info.pop(_PENDING_KEY, None)
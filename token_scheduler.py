@@ -0,0 +1,266 @@
+"""选号策略与并发控制。
+
+- 策略可插拔：round_robin（默认，与原来的多号轮询一致）、least_in_flight、weighted，
+  以及 token_latency 注册的 latency；
+- 记录每个 token 正在处理的请求数，并按请求类型执行 image_concurrency / video_concurrency /
+  TOKEN_CHAT_CONCURRENCY 上限（-1 表示不限制）；
+- 限流冷却中的 token 不参与选号，配额快耗尽的 token 只作为兜底候选；
+- 熔断（open）的 token 不参与选号，退避结束后只放行一个探测请求；
+- ADAPTIVE_LIMIT_ENABLED 开启时在途请求数不超过 adaptive_limit 计算的上限；
+- 模型目录中已知的模型只发给支持该模型的 token；
+- 低优先级请求只使用 PRIORITY_RESERVED_SHARE 预留之外的余量（并发上限和剩余配额），
+  预留部分只给高优先级请求。
+"""
+import heapq
+import math
+import random
+from threading import Lock
+
+import adaptive_limit
+import circuit_breaker
+import model_catalog
+import rate_limits
+import settings
+from token_pool import TokenPool, TokenRecord, pool
+
+KIND_CHAT = 'chat'
+KIND_IMAGE = 'image'
+KIND_VIDEO = 'video'
+
+PRIORITY_HIGH = 'high'
+PRIORITY_LOW = 'low'
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_LOW)
+
+_VIDEO_MODEL_HINTS = ('video', 'sora', 'veo', 'kling', 'hailuo')
+_IMAGE_MODEL_HINTS = ('image', 'dall-e', 'dalle', 'imagen', 'flux', 'midjourney', 'seedream')
+
+
+def request_kind(model: str | None) -> str:
+    name = (model or '').lower()
+    if any(hint in name for hint in _VIDEO_MODEL_HINTS):
+        return KIND_VIDEO
+    if any(hint in name for hint in _IMAGE_MODEL_HINTS):
+        return KIND_IMAGE
+    return KIND_CHAT
+
+
+def concurrency_cap(record: TokenRecord, kind: str) -> int | None:
+    """None 表示不限制。"""
+    if kind == KIND_IMAGE:
+        cap = record.image_concurrency
+    elif kind == KIND_VIDEO:
+        cap = record.video_concurrency
+    else:
+        cap = settings.TOKEN_CHAT_CONCURRENCY
+    if cap is None or int(cap) < 0:
+        return None
+    return int(cap)
+
+
+def eligible(record: TokenRecord, kind: str) -> bool:
+    if kind == KIND_IMAGE and record.image_enabled is False:
+        return False
+    if kind == KIND_VIDEO and record.video_enabled is False:
+        return False
+    if rate_limits.is_cooling(record) or not circuit_breaker.allows(record):
+        return False
+    limit = adaptive_limit.cap(record)
+    if limit is not None and record.in_flight >= limit:
+        return False
+    cap = concurrency_cap(record, kind)
+    return cap is None or record.kind_in_flight.get(kind, 0) < cap
+
+
+def low_priority_cap(cap: int) -> int:
+    """并发上限中低优先级请求可用的部分。
+
+    预留部分向上取整且至少 1 个；上限只有 1 时无法预留（否则低优先级请求永远用不上这个
+    token），低优先级请求也可以使用。
+    """
+    share = settings.PRIORITY_RESERVED_SHARE
+    if share <= 0 or cap <= 1:
+        return cap
+    reserved = max(1, math.ceil(cap * share - 1e-9))
+    return max(0, cap - reserved)
+
+
+def headroom(record: TokenRecord, kind: str) -> bool:
+    """是否还有预留之外的余量可给低优先级请求。"""
+    reserve = settings.PRIORITY_RESERVED_SHARE
+    if reserve <= 0:
+        return True
+    cap = concurrency_cap(record, kind)
+    if cap is not None and record.kind_in_flight.get(kind, 0) >= low_priority_cap(cap):
+        return False
+    # 自适应上限始终计算：即使没有配置任何并发上限，低优先级请求也只用它预留之外的部分
+    if record.in_flight >= low_priority_cap(adaptive_limit.current(record)):
+        return False
+    estimate = rate_limits.estimated_remaining(record)
+    if estimate is not None and record.rl_limit and estimate / record.rl_limit < reserve:
+        return False
+    return True
+
+
+def tier(record: TokenRecord, kind: str) -> int | None:
+    """0 = 优先候选，1 = 兜底候选，None = 不可选。"""
+    if not eligible(record, kind):
+        return None
+    return 1 if rate_limits.near_exhaustion(record) else 0
+
+
+_lock = Lock()
+_release_hooks = []
+
+
+def on_release(hook):
+    """注册名额归还时的回调（准入队列据此唤醒等待的请求）。"""
+    _release_hooks.append(hook)
+
+
+class Lease:
+    """一次占用 token 的凭据；release() 可重复调用。"""
+    __slots__ = ('record', 'kind', 'probe', '_released')
+
+    def __init__(self, record: TokenRecord, kind: str, probe: bool = False):
+        self.record = record
+        self.kind = kind
+        self.probe = probe  # 是否为熔断后的探测请求
+        self._released = False
+
+    def release(self):
+        with _lock:
+            if self._released:
+                return
+            self._released = True
+            record = self.record
+            record.in_flight = max(0, record.in_flight - 1)
+            record.kind_in_flight[self.kind] = max(0, record.kind_in_flight.get(self.kind, 0) - 1)
+        if self.probe and self.record.cb_probe_in_flight:
+            circuit_breaker.release_probe(self.record)
+        for hook in _release_hooks:
+            hook()
+
+
+def acquire(record: TokenRecord, kind: str, priority: str = PRIORITY_HIGH) -> Lease | None:
+    """检查并发上限并占用一个名额；已满（低优先级请求：没有余量）时返回 None。"""
+    with _lock:
+        if not eligible(record, kind):
+            return None
+        if priority == PRIORITY_LOW and not headroom(record, kind):
+            return None
+        record.in_flight += 1
+        record.kind_in_flight[kind] = record.kind_in_flight.get(kind, 0) + 1
+        probe = circuit_breaker.claim(record)
+    return Lease(record, kind, probe)
+
+
+# --- 选号策略 ---
+# select(token_pool, limit, tier_of) 返回最多 limit 个候选；tier_of(record) 给出分层，
+# 所有 0 层候选排在 1 层之前，None 表示跳过。
+
+class RoundRobinStrategy:
+    name = 'round_robin'
+
+    def select(self, token_pool: TokenPool, limit: int, tier_of) -> list[TokenRecord]:
+        ring, start = token_pool.rotate()
+        n = len(ring)
+        preferred, fallback = [], []
+        for i in range(n):
+            record = ring[(start + i) % n]
+            level = tier_of(record)
+            if level == 0:
+                preferred.append(record)
+                if len(preferred) >= limit:
+                    break
+            elif level is not None and len(fallback) < limit:
+                fallback.append(record)
+        return (preferred + fallback)[:limit]
+
+
+class LeastInFlightStrategy:
+    """优先选择正在处理请求最少的 token；并列时按轮询顺序。"""
+    name = 'least_in_flight'
+
+    def select(self, token_pool: TokenPool, limit: int, tier_of) -> list[TokenRecord]:
+        ring, start = token_pool.rotate()
+        n = len(ring)
+        ranked = []
+        for i in range(n):
+            record = ring[(start + i) % n]
+            level = tier_of(record)
+            if level is not None:
+                ranked.append((level, record.in_flight, i, record))
+        return [item[-1] for item in heapq.nsmallest(limit, ranked)]
+
+
+class WeightedStrategy:
+    """按 Token.weight 加权随机（不放回抽样），weight <= 0 的 token 不参与。"""
+    name = 'weighted'
+
+    def select(self, token_pool: TokenPool, limit: int, tier_of) -> list[TokenRecord]:
+        ring, _ = token_pool.rotate()
+        keyed = []
+        for i, record in enumerate(ring):
+            weight = record.weight if record.weight is not None else 1
+            if weight <= 0:
+                continue
+            level = tier_of(record)
+            if level is None:
+                continue
+            keyed.append((-level, random.random() ** (1.0 / weight), i, record))
+        return [item[-1] for item in heapq.nlargest(limit, keyed)]
+
+
+STRATEGIES = {}
+
+
+def register_strategy(strategy):
+    STRATEGIES[strategy.name] = strategy
+
+
+for _strategy in (RoundRobinStrategy(), LeastInFlightStrategy(), WeightedStrategy()):
+    register_strategy(_strategy)
+
+
+def get_strategy(name: str | None = None):
+    return STRATEGIES.get(name or settings.TOKEN_SELECTION_STRATEGY) or STRATEGIES['round_robin']
+
+
+def select(kind: str, limit: int, model: str | None = None, priority: str = PRIORITY_HIGH) -> list[TokenRecord]:
+    if model_catalog.known(model):
+        def tier_of(record):
+            return tier(record, kind) if model_catalog.supports(record, model) else None
+    else:
+        def tier_of(record):
+            return tier(record, kind)
+    if priority == PRIORITY_LOW:
+        base = tier_of
+
+        def tier_of(record):
+            return base(record) if headroom(record, kind) else None
+    return get_strategy().select(pool, limit, tier_of)
+
+
+def stats() -> dict:
+    return {
+        'strategy': get_strategy().name,
+        'strategies': sorted(STRATEGIES),
+        'priority_reserved_share': settings.PRIORITY_RESERVED_SHARE,
+        'tokens': [
+            {
+                'id': r.id,
+                'email': r.email,
+                'in_flight': r.in_flight,
+                'in_flight_by_kind': dict(r.kind_in_flight),
+                'image_concurrency': r.image_concurrency,
+                'video_concurrency': r.video_concurrency,
+                'weight': r.weight,
+                'timeouts': dict(r.timeouts),
+                'model_count': len(r.models) if r.models is not None else None,
+                **rate_limits.snapshot(r),
+                **circuit_breaker.snapshot(r),
+                **adaptive_limit.snapshot(r),
+            }
+            for r in sorted(pool.records(), key=lambda r: r.id)
+        ],
+    }
@@ -0,0 +1,171 @@
+"""进程级共享的 zai.is 上游 HTTP 客户端（连接池 + keep-alive + 预热）。"""
+import logging
+import socket
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+_checkout = threading.local()
+
+
+@contextmanager
+def on_checkout(hook):
+    """在当前线程内从连接池借出连接时调用 hook(conn)，调用方据此可以在其他线程中止请求。"""
+    _checkout.hook = hook
+    try:
+        yield
+    finally:
+        _checkout.hook = None
+
+
+def abort_connection(conn):
+    """从其他线程中止连接上正在阻塞的读写；还在建立连接时无法中止，等连接超时。"""
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class _PoolStatsMixin:
+    """在 urllib3 连接池上统计借出/归还次数。"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.stats_in_use = 0
+        self.stats_checkouts = 0
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        with self._stats_lock:
+            self.stats_in_use += 1
+            self.stats_checkouts += 1
+        hook = getattr(_checkout, 'hook', None)
+        if hook is not None:
+            hook(conn)
+        return conn
+
+    def _put_conn(self, conn):
+        with self._stats_lock:
+            self.stats_in_use = max(0, self.stats_in_use - 1)
+        super()._put_conn(conn)
+
+
+class _StatsHTTPConnectionPool(_PoolStatsMixin, HTTPConnectionPool):
+    pass
+
+
+class _StatsHTTPSConnectionPool(_PoolStatsMixin, HTTPSConnectionPool):
+    pass
+
+
+def _enable_http2() -> bool:
+    """urllib3 的 HTTP/2 仍是实验特性，只有显式开启且依赖齐全时才注入。"""
+    try:
+        import h2  # noqa: F401
+        import urllib3.http2
+    except ImportError:
+        logger.warning("UPSTREAM_HTTP2 is set but urllib3.http2/h2 is unavailable, using HTTP/1.1")
+        return False
+    urllib3.http2.inject_into_urllib3()
+    return True
+
+
+class UpstreamClient:
+    def __init__(self, base_url: str, pool_size: int, http2: bool = False):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = max(1, pool_size)
+        self.http2 = _enable_http2() if http2 else False
+
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, max_retries=0)
+        self.adapter.poolmanager.pool_classes_by_scheme = {
+            'http': _StatsHTTPConnectionPool,
+            'https': _StatsHTTPSConnectionPool,
+        }
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.session.get(self.url(path), **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.session.post(self.url(path), **kwargs)
+
+    def _pools(self):
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                yield pool
+
+    def _pool_for_base_url(self):
+        # 必须与 Session 实际请求时使用同一个连接池（连接池 key 包含 TLS 参数）
+        prepared = requests.Request('GET', self.base_url).prepare()
+        if hasattr(self.adapter, 'get_connection_with_tls_context'):
+            env = self.session.merge_environment_settings(self.base_url, {}, None, None, None)
+            return self.adapter.get_connection_with_tls_context(prepared, verify=env['verify'], cert=env['cert'])
+        return self.adapter.get_connection(self.base_url)
+
+    def prewarm(self, count: int):
+        """预先完成 TCP + TLS 握手并放回连接池。"""
+        count = min(max(0, count), self.pool_size)
+        if count == 0:
+            return
+        if requests.utils.get_environ_proxies(self.base_url):
+            # 走环境变量代理时连接由 ProxyManager 管理，预热直连没有意义
+            return
+        pool = self._pool_for_base_url()
+        conns = []
+        try:
+            for _ in range(count):
+                conn = pool._get_conn()
+                conns.append(conn)
+                conn.connect()
+        except Exception as e:
+            logger.warning(f"Upstream prewarm stopped after {len(conns)} connection(s): {e}")
+        finally:
+            for conn in conns:
+                pool._put_conn(conn)
+        logger.info(f"Upstream pool prewarmed with {len(conns)} connection(s) to {self.base_url}")
+
+    def prewarm_async(self, count: int):
+        threading.Thread(target=self.prewarm, args=(count,), name='upstream-prewarm', daemon=True).start()
+
+    def stats(self) -> dict:
+        idle = in_use = created = checkouts = 0
+        hosts = []
+        for pool in self._pools():
+            queued = list(pool.pool.queue) if pool.pool is not None else []
+            pool_idle = sum(1 for c in queued if c is not None and getattr(c, 'sock', None) is not None)
+            idle += pool_idle
+            in_use += getattr(pool, 'stats_in_use', 0)
+            created += pool.num_connections
+            checkouts += getattr(pool, 'stats_checkouts', 0)
+            hosts.append(f"{pool.scheme}://{pool.host}:{pool.port}")
+        return {
+            'base_url': self.base_url,
+            'http2': self.http2,
+            'pool_size': self.pool_size,
+            'hosts': hosts,
+            'idle': idle,
+            'in_use': in_use,
+            'created': created,
+            'reused': max(0, checkouts - created),
+        }
+
+
+client = UpstreamClient(settings.ZAI_BASE_URL, settings.UPSTREAM_POOL_SIZE, http2=settings.UPSTREAM_HTTP2)